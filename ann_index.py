@@ -0,0 +1,213 @@
+import json
+import logging
+import math
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+ANN_REPORT = "ann_index.json"
+
+# Кодеки хранения векторов: float32, float16, 8-битный скалярный квантователь, PQ
+CODECS = ("flat", "fp16", "sq8", "pq")
+PQ_MIN_TRAIN = 39 * 256  # faiss: не меньше 39 обучающих векторов на центроид 8-битного кода
+CODEC_MIN_TRAIN = {"sq8": 1024, "pq": PQ_MIN_TRAIN}  # векторов для обучения кодека инкрементного индекса
+
+# Перебираемые значения параметра поиска (от быстрых к точным)
+NPROBE_GRID = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+EF_SEARCH_GRID = (16, 32, 64, 128, 256, 512)
+
+
+def pq_subquantizers(dim: int) -> int:
+    """Число подквантователей PQ: по одному байту на VECTOR_PQ_DIMS_PER_CODE измерений, делитель dim."""
+    m = max(1, dim // settings.VECTOR_PQ_DIMS_PER_CODE)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def resolve_codec(codec: str, n_vectors: int) -> str:
+    """Проверяет кодек; PQ на малой выборке не обучить, для неё используется SQ8."""
+    if codec not in CODECS:
+        raise ValueError(f"Неизвестный кодек векторов: {codec} (доступны: {', '.join(CODECS)})")
+    if codec == "pq" and n_vectors < PQ_MIN_TRAIN:
+        return "sq8"
+    return codec
+
+
+def codec_factory(codec: str, dim: int) -> str:
+    """Часть строки index_factory, задающая хранение векторов."""
+    return {"flat": "Flat", "fp16": "SQfp16", "sq8": "SQ8", "pq": f"PQ{pq_subquantizers(dim)}"}[codec]
+
+
+def choose_index_factory(n_vectors: int, dim: int, codec: str = "flat") -> Tuple[str, Optional[str], Tuple[int, ...]]:
+    """
+    Выбирает тип индекса по числу векторов и кодеку хранения.
+    Возвращает (строка index_factory, параметр поиска, сетка значений).
+    """
+    storage = codec_factory(codec, dim)
+    if n_vectors <= settings.ANN_FLAT_MAX_CHUNKS:
+        return storage, None, ()
+    if n_vectors <= settings.ANN_HNSW_MAX_CHUNKS:
+        return f"HNSW{settings.ANN_HNSW_M},{storage}", "efSearch", EF_SEARCH_GRID
+    # Число кластеров ~ 4 * sqrt(N), степень двойки
+    nlist = 2 ** int(round(math.log2(4 * math.sqrt(n_vectors))))
+    return f"IVF{nlist},{storage}", "nprobe", tuple(value for value in NPROBE_GRID if value <= nlist)
+
+
+def _train_size(factory: str, n_vectors: int) -> int:
+    """На кластер IVF — 64 обучающих вектора; кодекам — не меньше VECTOR_CODEC_TRAIN_SIZE."""
+    size = settings.VECTOR_CODEC_TRAIN_SIZE
+    if factory.startswith("IVF"):
+        size = max(size, 64 * int(factory[3:factory.index(",")]))
+    return min(n_vectors, size)
+
+
+def _recall(found: np.ndarray, exact: np.ndarray, k: int) -> float:
+    hits = sum(len(set(row_found[:k]) & set(row_exact[:k])) for row_found, row_exact in zip(found, exact))
+    return hits / (len(exact) * k)
+
+
+def index_nbytes(index) -> int:
+    import faiss
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def build_ann_index(vectors: np.ndarray, codec: str = None):
+    """
+    Строит FAISS-индекс под размер корпуса (Flat, HNSW или IVF) с хранением
+    векторов в выбранном кодеке: float32, float16, SQ8 или PQ.
+
+    Для всех индексов, кроме точного float32 Flat, recall@k замеряется по
+    выборке запросов относительно точного поиска; у HNSW/IVF параметр поиска
+    (efSearch / nprobe) берётся наименьшим с recall@k не ниже ANN_TARGET_RECALL.
+    Возвращает индекс и отчёт о сборке (тип, кодек, объём, recall@k и время
+    поиска для каждого значения параметра).
+    """
+    import faiss
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectors.ndim != 2 or not len(vectors):
+        raise ValueError("Нет векторов для построения индекса")
+    n_vectors, dim = vectors.shape
+    requested_codec = codec or settings.VECTOR_CODEC
+    codec = resolve_codec(requested_codec, n_vectors)
+    factory, param, grid = choose_index_factory(n_vectors, dim, codec)
+    started = time.perf_counter()
+
+    index = faiss.index_factory(dim, factory)
+    rng = np.random.default_rng(0)
+    train_size = 0
+    if not index.is_trained:
+        train_size = _train_size(factory, n_vectors)
+        index.train(vectors[rng.choice(n_vectors, train_size, replace=False)])
+    index.add(vectors)
+
+    report = {
+        "factory": factory,
+        "codec": codec,
+        "requested_codec": requested_codec,
+        "vectors": n_vectors,
+        "dim": dim,
+        "train_size": train_size,
+        "param": param,
+        "value": None,
+        "k": settings.ANN_RECALL_K,
+        "recall_at_k": 1.0,
+        "trials": []
+    }
+    if factory != "Flat":
+        k = min(settings.ANN_RECALL_K, n_vectors)
+        queries = vectors[rng.choice(n_vectors, min(n_vectors, settings.ANN_RECALL_QUERIES), replace=False)]
+        exact_index = faiss.IndexFlatL2(dim)
+        exact_index.add(vectors)
+        search_started = time.perf_counter()
+        _, exact = exact_index.search(queries, k)
+        report["exact_ms_per_query"] = round((time.perf_counter() - search_started) * 1000 / len(queries), 4)
+
+        parameter_space = faiss.ParameterSpace()
+        for value in grid or (None,):
+            if value is not None:
+                parameter_space.set_index_parameter(index, param, value)
+            search_started = time.perf_counter()
+            _, found = index.search(queries, k)
+            elapsed = (time.perf_counter() - search_started) * 1000 / len(queries)
+            recall = _recall(found, exact, k)
+            report["trials"].append({"value": value, "recall_at_k": round(recall, 4),
+                                     "ms_per_query": round(elapsed, 4)})
+            report["value"], report["recall_at_k"] = value, round(recall, 4)
+            if recall >= settings.ANN_TARGET_RECALL:
+                break
+
+    report["index_bytes"] = index_nbytes(index)
+    report["float32_bytes"] = n_vectors * dim * 4
+    report["build_seconds"] = round(time.perf_counter() - started, 3)
+    logger.info(f"Построен индекс {factory} на {n_vectors} векторах: {param}={report['value']}, "
+                f"recall@{report['k']}={report['recall_at_k']}, {report['index_bytes']} байт "
+                f"(float32: {report['float32_bytes']})")
+    return index, report
+
+
+def evaluate_codecs(vectors: np.ndarray, codecs=CODECS, k: int = None, n_queries: int = None) -> List[Dict]:
+    """
+    Сравнивает кодеки хранения на одном наборе векторов: объём индекса,
+    экономию относительно float32 и recall@k относительно точного поиска.
+    """
+    import faiss
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n_vectors, dim = vectors.shape
+    k = min(k or settings.ANN_RECALL_K, n_vectors)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(n_vectors, min(n_vectors, n_queries or settings.ANN_RECALL_QUERIES), replace=False)]
+    exact_index = faiss.IndexFlatL2(dim)
+    exact_index.add(vectors)
+    _, exact = exact_index.search(queries, k)
+    float32_bytes = n_vectors * dim * 4
+
+    results = []
+    for requested_codec in codecs:
+        codec = resolve_codec(requested_codec, n_vectors)
+        index = faiss.index_factory(dim, codec_factory(codec, dim))
+        if not index.is_trained:
+            index.train(vectors[rng.choice(n_vectors, _train_size("", n_vectors), replace=False)])
+        index.add(vectors)
+        search_started = time.perf_counter()
+        _, found = index.search(queries, k)
+        elapsed = (time.perf_counter() - search_started) * 1000 / len(queries)
+        index_bytes = index_nbytes(index)
+        results.append({
+            "codec": codec,
+            "requested_codec": requested_codec,
+            "bytes_per_vector": round(index_bytes / n_vectors, 1),
+            "index_bytes": index_bytes,
+            "saved_percent": round(100 * (1 - index_bytes / float32_bytes), 1),
+            "recall_at_k": round(_recall(found, exact, k), 4),
+            "ms_per_query": round(elapsed, 4)
+        })
+    return results
+
+
+def apply_search_params(index, report: Optional[Dict]) -> None:
+    """Восстанавливает подобранный параметр поиска после загрузки индекса с диска."""
+    if report and report.get("param") and report.get("value") is not None:
+        import faiss
+        faiss.ParameterSpace().set_index_parameter(index, report["param"], report["value"])
+
+
+def save_ann_report(directory: str, report: Dict) -> None:
+    with open(os.path.join(directory, ANN_REPORT), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def load_ann_report(directory: str) -> Optional[Dict]:
+    path = os.path.join(directory, ANN_REPORT)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
@@ -15,6 +15,7 @@ class Settings(BaseSettings):
     
     # Настройки файлов
     MAX_FILE_SIZE: int = 10 * 1024 * 1024  # 10MB
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024  # размер блока при потоковой записи загрузки
     ALLOWED_EXTENSIONS: List[str] = [".pdf", ".docx", ".txt"]
     
     # Настройки базы данных
@@ -25,9 +26,82 @@ class Settings(BaseSettings):
     MODEL_NAME: str = "deepseek-r1-distill-llama-70b"  # Более вероятная модель для Groq
     MAX_TOKENS: int = 32000
     TEMPERATURE: float = 0
+    LLM_MAX_CONCURRENCY: int = 4  # одновременных запросов к LLM на процесс
+    LLM_TIMEOUT: float = 120.0  # секунд на один запрос
+    LLM_BUDGET_WAIT_TIMEOUT: float = 600.0  # сколько ждать ключ со свободным лимитом до ошибки
+    LLM_MAX_RETRIES: int = 3  # повторов при 429/413 на другом ключе
+    LLM_RETRY_DELAY: float = 2.0  # начальная задержка отложенного ключа, удваивается при повторных 429
+    LLM_RETRY_MAX_DELAY: float = 60.0
+    LLM_REQUESTS_PER_MINUTE: int = 30  # лимиты Groq на один ключ
+    LLM_TOKENS_PER_MINUTE: int = 6000
+    LLM_COMPLETION_TOKENS_ESTIMATE: int = 1000  # резерв под ответ; уточняется по фактическому расходу
+    KEY_POOL_DB_PATH: str = "vector_db/key_pool.sqlite"  # состояние лимитов ключей, общее для воркеров
+    LLM_CHARS_PER_TOKEN: float = 3.0  # оценка длины промпта без токенизатора модели (кириллица)
+    COMPARISON_BATCH_TOKENS: int = 1000  # токенов требований в одном запросе сравнения
+    COMPARISON_BATCH_MAX_REQUIREMENTS: int = 12  # требований в одном запросе сравнения
+    BATCH_MAX_CONCURRENT_PAIRS: int = 4  # пар ТЗ/документ, сравниваемых одновременно в /compare-batch
+    TZ_EXTRACTION_CHUNK_CHARS: int = 8000  # символов ТЗ в одном запросе извлечения требований
+    TZ_DUPLICATE_SIMILARITY: float = 0.8  # сходство терминов, при котором требования считаются повтором
     
     # Настройки базы данных векторов
     VECTOR_DB_PATH: str = "vector_db"
+    INDEX_CACHE_SIZE: int = 16  # FAISS-индексов документов в памяти процесса
+    INDEX_BUILD_LOCK_TIMEOUT: int = 900  # секунд ожидания чужой сборки индекса
+    EVIDENCE_TOP_K: int = 3  # чанков документации на одно требование
+    EVIDENCE_MAX_CHARS: int = 10000  # объём контекста документации в одном запросе сравнения
+    HYBRID_ALPHA: float = 0.5  # вес векторного ранга в гибридном поиске (остальное — BM25)
+    HYBRID_CANDIDATES: int = 50  # кандидатов от каждого из поисков для слияния рангов
+    HYBRID_MATCH_COVERAGE: float = 0.8  # доля терминов требования в чанке для совпадения в fallback
+    ANN_FLAT_MAX_CHUNKS: int = 10000  # до этого числа чанков — точный Flat-индекс
+    ANN_HNSW_MAX_CHUNKS: int = 100000  # до этого — HNSW, больше — IVF
+    ANN_HNSW_M: int = 32
+    ANN_TARGET_RECALL: float = 0.95  # целевой recall@k при подборе nprobe/efSearch
+    ANN_RECALL_K: int = 10
+    ANN_RECALL_QUERIES: int = 200  # запросов для замера recall при сборке
+    VECTOR_CODEC: str = "flat"  # хранение векторов документов: flat, fp16, sq8, pq
+    VECTOR_PQ_DIMS_PER_CODE: int = 4  # PQ: измерений на байт кода
+    VECTOR_CODEC_TRAIN_SIZE: int = 65536  # максимум векторов для обучения квантователя
+    LIBRARY_INDEX_DIR: str = "vector_db/library"  # библиотечный индекс по всем документам
+    LIBRARY_SEARCH_TOP_K: int = 10
+    LIBRARY_CODEC: str = "flat"  # хранение векторов библиотеки: flat, fp16, sq8, pq
+
+    # Модель и бэкенд эмбеддингов
+    EMBEDDING_MODEL: str = "sentence-transformers/all-MiniLM-L6-v2"
+    EMBEDDING_BACKEND: str = "torch"  # torch или onnx (int8, ONNX Runtime CPU)
+    EMBEDDING_BATCH_SIZE: int = 32
+    EMBEDDING_INTRA_OP_THREADS: int = os.cpu_count() or 1
+    EMBEDDING_INTER_OP_THREADS: int = 1
+    ONNX_MODEL_DIR: str = "models/onnx"
+    EMBEDDING_PARITY_MIN_COSINE: float = 0.99  # минимальный косинус ONNX/PyTorch для включения ONNX
+    LOCAL_MODEL_DIR: str = "models"  # локальные копии моделей: models/<модель>
+    MODEL_LOCAL_FILES_ONLY: bool = True  # не обращаться к Hugging Face Hub при загрузке моделей
+
+    # Прогрев моделей при старте
+    WARMUP_ON_STARTUP: bool = True
+    COLD_START_BUDGET: float = 60.0  # секунд от старта до готовности (/ready)
+
+    # Кэш эмбеддингов чанков (матрица в отображаемом в память файле)
+    EMBEDDING_CACHE_DIR: str = "vector_db/embedding_cache"
+    EMBEDDING_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    EMBEDDING_CACHE_DTYPE: str = "float16"  # float16 или float32
+
+    # Кэш ответов LLM (в памяти процесса и в таблице llm_responses)
+    LLM_CACHE_ENABLED: bool = True
+    LLM_CACHE_MEMORY_BYTES: int = 16 * 1024 * 1024
+    LLM_CACHE_TTL_DAYS: int = 30
+    LLM_CACHE_MAX_DB_BYTES: int = 256 * 1024 * 1024
+
+    # Кэш извлечённого текста
+    EXTRACTED_TEXT_DIR: str = "extracted_text"
+    TEXT_CACHE_MAX_BYTES: int = 256 * 1024 * 1024  # 256MB в памяти процесса
+    FIND_CONTEXT_CHARS: int = 100  # символов контекста с каждой стороны точного совпадения в /find-in-document
+
+    # Пул процессов для извлечения текста
+    EXTRACTION_WORKERS: int = max(1, (os.cpu_count() or 2) - 1)
+    EXTRACTION_TIMEOUT: int = 300  # секунд на один документ
+    EXTRACTION_QUEUE_SIZE: int = 32  # задач, ожидающих свободного процесса
+    LARGE_PDF_MIN_PAGES: int = 100  # с этого числа страниц PDF извлекается диапазонами параллельно
+    PDF_PAGE_RANGE_SIZE: int = 25  # страниц в одной задаче пула
     
     class Config:
         case_sensitive = True
@@ -1,8 +1,9 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
 from sqlalchemy import (Column, Integer, String, DateTime, ForeignKey, Text,
-                        Index, Boolean, JSON, func, text)
+                        Index, Boolean, JSON, func, inspect, text)
 from datetime import datetime, timedelta
+from typing import List, Tuple
 import os
 import logging
 
@@ -26,6 +27,7 @@ class UploadedFile(Base):
     file_type = Column(String, nullable=False)
     file_size = Column(Integer, nullable=False)
     md5_hash = Column(String, nullable=False)
+    ref_count = Column(Integer, default=1, nullable=False)  # число загрузок, ссылающихся на блоб
     is_deleted = Column(Boolean, default=False)
     delete_date = Column(DateTime, nullable=True)
     upload_date = Column(DateTime, nullable=False)
@@ -49,6 +51,7 @@ class ComparisonSession(Base):
     __tablename__ = "comparison_sessions"
     id = Column(Integer, primary_key=True)
     session_id = Column(String(255), unique=True, nullable=False)
+    batch_id = Column(String(255), nullable=True)  # группа сессий пакетного сравнения N×M
     tz_file_id = Column(Integer, ForeignKey('uploaded_files.id'))
     doc_file_id = Column(Integer, ForeignKey('uploaded_files.id'))
     status = Column(String(50), default='processing')
@@ -66,16 +69,71 @@ class ComparisonSession(Base):
         Index('idx_session_status', status),
         Index('idx_created_at', created_at),
         Index('idx_session_id', session_id),
+        Index('idx_batch_id', batch_id),
     )
 
 
+class ExtractedText(Base):
+    __tablename__ = "extracted_texts"
+    id = Column(Integer, primary_key=True)
+    md5_hash = Column(String, unique=True, nullable=False)
+    text_path = Column(String, nullable=False)
+    char_count = Column(Integer, nullable=False)
+    compressed_size = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index('idx_extracted_md5_hash', md5_hash),
+    )
+
+
+class LLMResponse(Base):
+    __tablename__ = "llm_responses"
+    id = Column(Integer, primary_key=True)
+    cache_key = Column(String(64), unique=True, nullable=False)  # sha256: модель, версия промпта, промпт
+    model = Column(String, nullable=False)
+    prompt_version = Column(String, nullable=False)
+    response = Column(Text, nullable=False)
+    size = Column(Integer, nullable=False)
+    hits = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    last_used_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index('idx_llm_response_created_at', created_at),
+        Index('idx_llm_response_last_used_at', last_used_at),
+    )
+
+
+# Колонки, добавленные в уже существующие таблицы: create_all их не создаёт
+ADDED_COLUMNS = [
+    ("uploaded_files", "ref_count", "INTEGER NOT NULL DEFAULT 1"),
+    ("comparison_sessions", "batch_id", "VARCHAR(255)"),
+]
+ADDED_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_batch_id ON comparison_sessions (batch_id)",
+]
+
+
+def upgrade_schema(connection) -> None:
+    """Идемпотентно добавляет новые колонки и индексы в таблицы, созданные старой версией."""
+    inspector = inspect(connection)
+    for table, column, ddl in ADDED_COLUMNS:
+        if column not in {existing["name"] for existing in inspector.get_columns(table)}:
+            logger.info(f"Adding column {table}.{column}")
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    for statement in ADDED_INDEXES:
+        connection.execute(text(statement))
+
+
 # Функция для создания таблиц
 async def create_tables(engine: AsyncEngine):
-    """Создание всех таблиц в базе данных."""
+    """Создание всех таблиц в базе данных и добавление новых колонок в существующие."""
     try:
         async with engine.begin() as conn:
             logger.info("Creating database tables...")
             await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(upgrade_schema)
             logger.info("Database tables created successfully.")
     except Exception as e:
         logger.error(f"Error creating database tables: {e}")
@@ -87,14 +145,12 @@ class DatabaseManager:
     def __init__(self):
         self.engine = engine
 
-    async def cleanup_old_files(self, days: int = 30):
-        """Очистка старых файлов"""
+    async def cleanup_old_files(self, days: int = 30) -> List[Tuple[str, str]]:
+        """Очистка старых файлов. Возвращает (stored_name, md5_hash) помеченных удалёнными файлов."""
         async with AsyncSessionLocal() as session:
             cutoff_date = datetime.utcnow() - timedelta(days=days)
-            query = """
-                UPDATE uploaded_files
-                SET is_deleted = true,
-                    delete_date = :now
+            params = {"cutoff_date": cutoff_date, "now": datetime.utcnow()}
+            condition = """
                 WHERE upload_date < :cutoff_date
                 AND is_deleted = false
                 AND id NOT IN (
@@ -105,11 +161,17 @@ class DatabaseManager:
                     WHERE created_at >= :cutoff_date
                 )
             """
-            await session.execute(text(query), {
-                "cutoff_date": cutoff_date,
-                "now": datetime.utcnow()
-            })
+            result = await session.execute(text("SELECT stored_name, md5_hash FROM uploaded_files" + condition), params)
+            removed = [(row[0], row[1]) for row in result.fetchall()]
+            query = """
+                UPDATE uploaded_files
+                SET is_deleted = true,
+                    ref_count = 0,
+                    delete_date = :now
+            """ + condition
+            await session.execute(text(query), params)
             await session.commit()
+            return removed
 
     async def get_storage_stats(self):
         """Получение статистики хранилища"""
@@ -1,64 +1,254 @@
 import os
-from typing import Optional
-import textract
+import codecs
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
 import logging
 import chardet
+from PyPDF2 import PdfReader
+import docx
+from docx.oxml.ns import qn
+from docx.table import Table
+from docx.text.paragraph import Paragraph
+from document_model import StructuredDocument
 
 logger = logging.getLogger(__name__)
 
+# Разделители между страницами PDF и абзацами DOCX в итоговом тексте
+PAGE_SEPARATOR = "\n\n"
+PARAGRAPH_SEPARATOR = "\n"
+
+# Определение кодировки TXT по ограниченной выборке из начала файла
+ENCODING_SAMPLE_SIZE = 64 * 1024
+ENCODING_MIN_CONFIDENCE = 0.5
+DEFAULT_LEGACY_ENCODING = 'cp1251'
+TXT_READ_CHUNK_SIZE = 1024 * 1024
+ENCODING_CACHE_SIZE = 1024
+
+# Результаты определения по хэшу выборки: кодировка зависит только от неё
+_encoding_cache: "OrderedDict[str, str]" = OrderedDict()
+_encoding_cache_lock = threading.Lock()
+
+
+def detect_encoding(sample: bytes) -> str:
+    """Определяет кодировку по выборке: BOM, затем строгий UTF-8, затем chardet."""
+    key = hashlib.blake2b(sample, digest_size=16).hexdigest()
+    with _encoding_cache_lock:
+        cached = _encoding_cache.get(key)
+        if cached:
+            _encoding_cache.move_to_end(key)
+            return cached
+
+    if sample.startswith(codecs.BOM_UTF8):
+        encoding = 'utf-8-sig'
+    else:
+        try:
+            # final=False: выборка может обрываться посреди многобайтового символа
+            codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            guess = chardet.detect(sample)
+            encoding = guess.get('encoding')
+            if not encoding or (guess.get('confidence') or 0) < ENCODING_MIN_CONFIDENCE:
+                encoding = DEFAULT_LEGACY_ENCODING
+            try:
+                encoding = codecs.lookup(encoding).name
+            except LookupError:
+                encoding = DEFAULT_LEGACY_ENCODING
+
+    with _encoding_cache_lock:
+        _encoding_cache[key] = encoding
+        while len(_encoding_cache) > ENCODING_CACHE_SIZE:
+            _encoding_cache.popitem(last=False)
+    return encoding
+
+
 class DocumentLoader:
     def _normalize_line_endings(self, text: str) -> str:
         text = text.replace('\r\n', '\n').replace('\r', '\n')
         return text
 
-    def load_document(self, file_path: str) -> Optional[str]:
+    def iter_pdf_pages(self, file_path: str, start: int = 0, end: Optional[int] = None) -> Iterator[str]:
+        """Постранично извлекает текст PDF (страницы [start, end)) без запуска внешних процессов."""
+        reader = PdfReader(file_path)
+        pages = reader.pages
+        end = len(pages) if end is None else min(end, len(pages))
+        for index in range(start, end):
+            yield pages[index].extract_text() or ""
+
+    def iter_docx_paragraphs(self, file_path: str) -> Iterator[str]:
+        """Извлекает абзацы DOCX в порядке документа, включая ячейки таблиц."""
+        document = docx.Document(file_path)
+        for child in document.element.body.iterchildren():
+            if child.tag == qn('w:p'):
+                yield Paragraph(child, document).text
+            elif child.tag == qn('w:tbl'):
+                seen_cells = set()
+                for row in Table(child, document).rows:
+                    for cell in row.cells:
+                        # Объединённые ячейки python-docx возвращает повторно
+                        if cell._tc in seen_cells:
+                            continue
+                        seen_cells.add(cell._tc)
+                        for paragraph in cell.paragraphs:
+                            yield paragraph.text
+
+    def _assemble(self, segments: Iterator[str], separator: str,
+                  keep_empty: bool) -> Tuple[str, List[int]]:
+        """Склеивает фрагменты в один текст, запоминая смещение начала каждого фрагмента."""
+        parts: List[str] = []
+        offsets: List[int] = []
+        position = 0
+        for segment in segments:
+            segment = self._normalize_line_endings(segment).strip()
+            if not segment and not keep_empty:
+                continue
+            if parts:
+                parts.append(separator)
+                position += len(separator)
+            offsets.append(position)
+            parts.append(segment)
+            position += len(segment)
+        return "".join(parts), offsets
+
+    def assemble_pages(self, pages: List[str]) -> Tuple[str, Dict[str, List[int]]]:
+        """Собирает текст PDF из уже извлечённых страниц (например, по диапазонам из пула)."""
+        text, offsets = self._assemble(iter(pages), PAGE_SEPARATOR, keep_empty=True)
+        return text, {"pages": offsets}
+
+    def _load_legacy_doc(self, file_path: str) -> Optional[str]:
+        """Старый формат .doc извлекается только через textract/antiword."""
+        import textract
+        raw_text = textract.process(file_path)
+        return raw_text.decode('utf-8', errors='ignore')
+
+    def load_document_with_offsets(self, file_path: str) -> Optional[Tuple[str, Dict[str, List[int]]]]:
+        """
+        Возвращает текст документа и таблицы смещений его структурных единиц:
+        {"pages": [...]} для PDF, {"paragraphs": [...]} для DOCX.
+        """
         try:
             logger.info(f"Проверка файла: {file_path}")
             if not os.path.exists(file_path):
                 logger.error(f"Файл не найден: {file_path}")
                 return None
-            
-            if file_path.lower().endswith('.txt'):
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        text = f.read()
-                    if text:
-                        text = self._normalize_line_endings(text)
-                        logger.info(f"Извлечен текст из TXT файла: {file_path} (длина: {len(text)})")
-                        return text.strip()
-                    logger.warning(f"TXT файл пуст: {file_path}")
-                    return None
-                except UnicodeDecodeError:
-                    encodings = ['cp1251', 'latin1', 'iso-8859-5']
-                    for encoding in encodings:
-                        try:
-                            with open(file_path, 'r', encoding=encoding) as f:
-                                text = f.read()
-                            if text:
-                                text = self._normalize_line_endings(text)
-                                logger.info(f"Извлечен текст из TXT файла с кодировкой {encoding}: {file_path}")
-                                return text.strip()
-                        except UnicodeDecodeError:
-                            continue
-                    logger.error(f"Не удалось прочитать TXT файл с поддерживаемыми кодировками: {file_path}")
-                    return None
-            
-            if file_path.lower().endswith(('.pdf', '.docx', '.doc')):
-                try:
-                    raw_text = textract.process(file_path, encoding='utf-8', errors='ignore')
-                    text = raw_text.decode('utf-8', errors='ignore')
-                    if text:
-                        text = self._normalize_line_endings(text)
-                        logger.info(f"Извлечен текст из файла {file_path} (длина: {len(text)})")
-                        return text.strip()
-                    logger.warning(f"Файл не содержит текста: {file_path}")
-                    return None
-                except Exception as e:
-                    logger.error(f"Ошибка при чтении файла {file_path}: {str(e)}")
+
+            lower_path = file_path.lower()
+            if lower_path.endswith('.txt'):
+                text = self._load_txt(file_path)
+                return (text, {}) if text else None
+
+            try:
+                if lower_path.endswith('.pdf'):
+                    text, layout = self.assemble_pages(list(self.iter_pdf_pages(file_path)))
+                elif lower_path.endswith('.docx'):
+                    text, offsets = self._assemble(self.iter_docx_paragraphs(file_path), PARAGRAPH_SEPARATOR,
+                                                   keep_empty=False)
+                    layout = {"paragraphs": offsets}
+                elif lower_path.endswith('.doc'):
+                    text = self._load_legacy_doc(file_path)
+                    text = self._normalize_line_endings(text).strip() if text else text
+                    layout = {}
+                else:
+                    logger.warning(f"Неподдерживаемый формат файла: {file_path}")
                     return None
-            
-            logger.warning(f"Неподдерживаемый формат файла: {file_path}")
-            return None
+            except Exception as e:
+                logger.error(f"Ошибка при чтении файла {file_path}: {str(e)}")
+                return None
+
+            if not text or not text.strip():
+                logger.warning(f"Файл не содержит текста: {file_path}")
+                return None
+            logger.info(f"Извлечен текст из файла {file_path} (длина: {len(text)})")
+            return text, layout
         except Exception as e:
             logger.error(f"Ошибка при чтении файла {file_path}: {str(e)}")
-            return None
\ No newline at end of file
+            return None
+
+    def _load_txt(self, file_path: str) -> Optional[str]:
+        """Читает TXT за один потоковый проход в кодировке, определённой по началу файла."""
+        with open(file_path, 'rb') as f:
+            sample = f.read(ENCODING_SAMPLE_SIZE)
+        if not sample:
+            logger.warning(f"TXT файл пуст: {file_path}")
+            return None
+
+        text, encoding = self._decode_txt(file_path, detect_encoding(sample))
+
+        text = text.strip()
+        if not text:
+            logger.warning(f"TXT файл пуст: {file_path}")
+            return None
+        logger.info(f"Извлечен текст из TXT файла с кодировкой {encoding}: {file_path} (длина: {len(text)})")
+        return text
+
+    def _decode_txt(self, file_path: str, encoding: str) -> Tuple[str, str]:
+        """
+        Декодирует файл строго в кодировке выборки. Выборка могла не отразить весь
+        файл (UTF-8 в начале, cp1251 дальше), поэтому при ошибке пробуются
+        кодировка, определённая по всему файлу, и DEFAULT_LEGACY_ENCODING; символы
+        заменяются только если не подошла ни одна. Возвращает (текст, кодировка).
+        """
+        tried: List[str] = []
+        for candidate in (encoding, None, DEFAULT_LEGACY_ENCODING):
+            candidate = candidate or self._detect_file_encoding(file_path)
+            if candidate in tried:
+                continue
+            tried.append(candidate)
+            try:
+                return self._read_txt(file_path, candidate, errors='strict'), candidate
+            except UnicodeDecodeError:
+                logger.warning(f"Ошибка декодирования {file_path} в {candidate}")
+        logger.warning(f"Ни одна кодировка не подошла для {file_path}, недопустимые символы {encoding} будут заменены")
+        return self._read_txt(file_path, encoding, errors='replace'), encoding
+
+    @staticmethod
+    def _detect_file_encoding(file_path: str) -> str:
+        """Определяет кодировку по всему файлу потоковым детектором chardet."""
+        detector = chardet.UniversalDetector()
+        with open(file_path, 'rb') as f:
+            while not detector.done:
+                chunk = f.read(TXT_READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                detector.feed(chunk)
+        detector.close()
+        encoding = detector.result.get('encoding')
+        if not encoding or (detector.result.get('confidence') or 0) < ENCODING_MIN_CONFIDENCE:
+            return DEFAULT_LEGACY_ENCODING
+        try:
+            return codecs.lookup(encoding).name
+        except LookupError:
+            return DEFAULT_LEGACY_ENCODING
+
+    def _read_txt(self, file_path: str, encoding: str, errors: str) -> str:
+        # newline=None переводит \r\n и \r в \n при чтении, без отдельного прохода
+        parts: List[str] = []
+        with open(file_path, 'r', encoding=encoding, errors=errors, newline=None) as f:
+            while True:
+                chunk = f.read(TXT_READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                parts.append(chunk)
+        return "".join(parts)
+
+    def load_document(self, file_path: str) -> Optional[str]:
+        result = self.load_document_with_offsets(file_path)
+        return result[0] if result else None
+
+
+def extract_document(file_path: str) -> Optional[StructuredDocument]:
+    """Точка входа для процессов пула: текст документа вместе с таблицами смещений."""
+    result = DocumentLoader().load_document_with_offsets(file_path)
+    return StructuredDocument.build(*result) if result else None
+
+
+def count_pdf_pages(file_path: str) -> int:
+    """Число страниц PDF (читается только таблица ссылок и дерево страниц)."""
+    return len(PdfReader(file_path).pages)
+
+
+def extract_pdf_page_range(file_path: str, start: int, end: int) -> List[str]:
+    """Точка входа для пула: текст страниц PDF в диапазоне [start, end)."""
+    return list(DocumentLoader().iter_pdf_pages(file_path, start, end))
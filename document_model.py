@@ -0,0 +1,255 @@
+import bisect
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+from array import array
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Формат файла смещений: сигнатура, четыре счётчика uint32, затем таблицы подряд.
+# В SDOC0001 предложения делились и после номеров пунктов и сокращений — при чтении пересчитываются
+OFFSETS_MAGIC = b"SDOC0002"
+LEGACY_OFFSETS_MAGIC = b"SDOC0001"
+TABLES = ("pages", "headings", "paragraphs", "sentences")
+_HEADER = struct.Struct("<8s4I")
+
+_SENTENCE_BREAK_RE = re.compile(r'[.!?]\s+')
+_LAST_TOKEN_RE = re.compile(r'\S+$')
+_NUMBER_TOKEN_RE = re.compile(r'^\d+(\.\d+)*\.$')  # «1.», «2.3.» — номер пункта, а не конец предложения
+_ABBREVIATIONS = frozenset("""
+т.е. т.к. т.д. т.п. т.н. и.т.д. и.т.п. рис. табл. стр. см. ср. др. пр. гл. разд. прил. п. пп. ст. им. ул. д.
+руб. коп. тыс. млн. млрд. мин. макс. прим. напр. e.g. i.e. fig.
+""".split())
+_LINE_RE = re.compile(r'[^\n]+')
+_NUMBERED_HEADING_RE = re.compile(r'^\d+(\.\d+)*\.?\s+\S')
+_CAPS_HEADING_RE = re.compile(r'^[А-ЯЁA-Z0-9][А-ЯЁA-Z0-9\s.,:-]{3,}$')
+MAX_HEADING_LENGTH = 120
+
+
+def _offsets(values: Sequence[int]) -> array:
+    return array('I', values)
+
+
+def _is_sentence_break(text: str, position: int) -> bool:
+    """Заканчивает ли знак препинания в позиции position предложение."""
+    if text[position] != '.':
+        return True
+    token = _LAST_TOKEN_RE.search(text, max(0, position - 20), position + 1)
+    if token is None:
+        return True
+    line_start = token.start() == 0 or text[token.start() - 1] == '\n'
+    token = token.group().lower()
+    # Номер пункта в начале строки, сокращения и инициалы («А.») не делят предложение
+    if _NUMBER_TOKEN_RE.match(token):
+        return not line_start
+    return not (token in _ABBREVIATIONS or (len(token) == 2 and token[0].isalpha()))
+
+
+def _sentence_starts(text: str, paragraphs: Sequence[int]) -> List[int]:
+    starts = {0}
+    starts.update(m.end() for m in _SENTENCE_BREAK_RE.finditer(text) if _is_sentence_break(text, m.start()))
+    starts.update(paragraphs)
+    return sorted(start for start in starts if start < len(text)) or [0]
+
+
+class StructuredDocument:
+    """
+    Текст документа и таблицы смещений (uint32) начала страниц, заголовков,
+    абзацев и предложений. Конец элемента — начало следующего (или конец текста).
+    Таблицы могут указывать прямо в отображённый в память файл смещений.
+    """
+
+    def __init__(self, text: str, tables: Dict[str, Sequence[int]], _mmap: Optional[mmap.mmap] = None):
+        self.text = text
+        self.pages = tables.get("pages") or _offsets([0])
+        self.headings = tables.get("headings") or _offsets([])
+        self.paragraphs = tables.get("paragraphs") or _offsets([0])
+        self.sentences = tables.get("sentences") or _offsets([0])
+        self._mmap = _mmap
+        self._chunks: Dict[Tuple[int, int], array] = {}
+        self._chunks_lock = threading.Lock()
+
+    def __getstate__(self):
+        # Для передачи из процессов пула: без блокировки, mmap и кэша фрагментов
+        return {"text": self.text, "tables": {name: array('I', getattr(self, name)) for name in TABLES}}
+
+    def __setstate__(self, state):
+        self.__init__(state["text"], state["tables"])
+
+    @classmethod
+    def build(cls, text: str, layout: Optional[Dict[str, List[int]]] = None) -> "StructuredDocument":
+        """Строит таблицы смещений по тексту и разметке, полученной от DocumentLoader."""
+        layout = layout or {}
+        paragraphs = layout.get("paragraphs") or [m.start() for m in _LINE_RE.finditer(text) if m.group().strip()]
+        paragraphs = paragraphs or [0]
+
+        headings = []
+        for index, start in enumerate(paragraphs):
+            end = paragraphs[index + 1] if index + 1 < len(paragraphs) else len(text)
+            line = text[start:end].strip()
+            if len(line) > MAX_HEADING_LENGTH or line.endswith((';', ',')):
+                continue
+            if _NUMBERED_HEADING_RE.match(line) or _CAPS_HEADING_RE.match(line):
+                headings.append(start)
+
+        return cls(text, {
+            "pages": _offsets(layout.get("pages") or [0]),
+            "headings": _offsets(headings),
+            "paragraphs": _offsets(paragraphs),
+            "sentences": _offsets(_sentence_starts(text, paragraphs)),
+        })
+
+    @property
+    def nbytes(self) -> int:
+        """Примерный объём памяти документа (для LRU-кэша)."""
+        size = sys.getsizeof(self.text)
+        if self._mmap is None:
+            size += sum(len(getattr(self, name)) * 4 for name in TABLES)
+        return size
+
+    def spans(self, table: str) -> Iterator[Tuple[int, int]]:
+        """Итерирует (начало, конец) элементов таблицы смещений."""
+        starts = getattr(self, table)
+        count = len(starts)
+        for index in range(count):
+            end = starts[index + 1] if index + 1 < count else len(self.text)
+            yield starts[index], end
+
+    def span_text(self, start: int, end: int) -> str:
+        return self.text[start:end].strip()
+
+    def locate(self, table: str, offset: int) -> int:
+        """Индекс элемента таблицы (страницы, абзаца...), содержащего смещение offset."""
+        return max(bisect.bisect_right(getattr(self, table), offset) - 1, 0)
+
+    def sentence_spans_between(self, start: int, end: int) -> List[Tuple[int, int]]:
+        """(начало, конец) предложений, пересекающихся с диапазоном [start, end)."""
+        first = self.locate("sentences", start)
+        last = self.locate("sentences", max(end - 1, start))
+        return [
+            (self.sentences[index], self.sentences[index + 1] if index + 1 < len(self.sentences) else len(self.text))
+            for index in range(first, last + 1)
+        ]
+
+    def sentences_between(self, start: int, end: int) -> List[str]:
+        """Предложения, пересекающиеся с диапазоном [start, end)."""
+        result = []
+        for sentence_start, sentence_end in self.sentence_spans_between(start, end):
+            sentence = self.span_text(sentence_start, sentence_end)
+            if sentence:
+                result.append(sentence)
+        return result
+
+    def chunks(self, chunk_size: int, overlap: int) -> List[Tuple[int, int]]:
+        """
+        Делит текст на фрагменты до chunk_size символов по границам предложений
+        с перекрытием около overlap символов. Результат кэшируется для пары параметров.
+        """
+        key = (chunk_size, overlap)
+        with self._chunks_lock:
+            cached = self._chunks.get(key)
+        if cached is None:
+            cached = _offsets(v for span in self._build_chunks(chunk_size, overlap) for v in span)
+            with self._chunks_lock:
+                self._chunks[key] = cached
+        return [(cached[i], cached[i + 1]) for i in range(0, len(cached), 2)]
+
+    def sections(self, max_chars: int) -> List[Tuple[int, int]]:
+        """
+        Делит текст на фрагменты до max_chars символов, начинающиеся с заголовков.
+        Соседние короткие разделы объединяются, длинный раздел делится по абзацам,
+        затем по предложениям.
+        """
+        bounds = sorted({0, *self.headings}) + [len(self.text)]
+        pieces = []
+        for start, end in zip(bounds, bounds[1:]):
+            pieces.extend(self._split_span(start, end, max_chars, ("paragraphs", "sentences")))
+        return [(start, end) for start, end in self._pack(pieces, max_chars) if self.text[start:end].strip()]
+
+    @staticmethod
+    def _pack(pieces: List[Tuple[int, int]], max_chars: int) -> List[Tuple[int, int]]:
+        packed = []
+        for start, end in pieces:
+            if packed and end - packed[-1][0] <= max_chars:
+                packed[-1] = (packed[-1][0], end)
+            else:
+                packed.append((start, end))
+        return packed
+
+    def _split_span(self, start: int, end: int, max_chars: int, tables: Tuple[str, ...]) -> List[Tuple[int, int]]:
+        if end - start <= max_chars:
+            return [(start, end)]
+        if not tables:
+            return [(offset, min(offset + max_chars, end)) for offset in range(start, end, max_chars)]
+        starts = getattr(self, tables[0])
+        bounds = [start, *starts[bisect.bisect_right(starts, start):bisect.bisect_left(starts, end)], end]
+        pieces = []
+        for piece_start, piece_end in zip(bounds, bounds[1:]):
+            pieces.extend(self._split_span(piece_start, piece_end, max_chars, tables[1:]))
+        return self._pack(pieces, max_chars)
+
+    def _sentence_units(self, chunk_size: int) -> List[Tuple[int, int]]:
+        units = []
+        for start, end in self.spans("sentences"):
+            # Слишком длинные предложения режем по пробелам
+            while end - start > chunk_size:
+                cut = self.text.rfind(' ', start + 1, start + chunk_size)
+                cut = cut if cut > start else start + chunk_size
+                units.append((start, cut))
+                start = cut
+            units.append((start, end))
+        return units
+
+    def _build_chunks(self, chunk_size: int, overlap: int) -> List[Tuple[int, int]]:
+        units = self._sentence_units(chunk_size)
+        chunks = []
+        index = 0
+        while index < len(units):
+            chunk_start = units[index][0]
+            last = index
+            while last + 1 < len(units) and units[last + 1][1] - chunk_start <= chunk_size:
+                last += 1
+            chunk_end = units[last][1]
+            if self.text[chunk_start:chunk_end].strip():
+                chunks.append((chunk_start, chunk_end))
+            if last + 1 >= len(units):
+                break
+            # Следующий фрагмент начинается с предложения, попадающего в перекрытие
+            next_index = last + 1
+            while next_index - 1 > index and units[next_index - 1][0] >= chunk_end - overlap:
+                next_index -= 1
+            index = next_index
+        return chunks
+
+    def save_offsets(self, path: str) -> None:
+        """Атомарно сохраняет таблицы смещений в двоичный файл."""
+        tables = [array('I', getattr(self, name)) for name in TABLES]
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(OFFSETS_MAGIC, *(len(table) for table in tables)))
+            for table in tables:
+                if sys.byteorder != "little":
+                    table.byteswap()
+                table.tofile(f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, text: str, offsets_path: str) -> "StructuredDocument":
+        """Открывает документ с таблицами смещений, отображёнными в память из файла."""
+        with open(offsets_path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, *counts = _HEADER.unpack_from(mapped, 0)
+        if magic not in (OFFSETS_MAGIC, LEGACY_OFFSETS_MAGIC) or sys.byteorder != "little":
+            mapped.close()
+            raise ValueError(f"Неподдерживаемый файл смещений: {offsets_path}")
+        view = memoryview(mapped)
+        tables = {}
+        position = _HEADER.size
+        for name, count in zip(TABLES, counts):
+            tables[name] = view[position:position + count * 4].cast('I')
+            position += count * 4
+        if magic == LEGACY_OFFSETS_MAGIC:
+            tables["sentences"] = _offsets(_sentence_starts(text, tables["paragraphs"]))
+        return cls(text, tables, _mmap=mapped)
@@ -0,0 +1,259 @@
+import json
+import logging
+import os
+import re
+import shutil
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+BACKEND_CONFIG = "onnx_backend.json"
+PARITY_RECORD = "parity.json"
+FP32_MODEL = "model.onnx"
+INT8_MODEL = "model.int8.onnx"
+WEIGHT_FILES = ("model.safetensors", "pytorch_model.bin")
+
+
+def model_slug(model_name: str) -> str:
+    return re.sub(r'[^\w.-]', '_', model_name)
+
+
+def onnx_model_dir(model_name: str) -> str:
+    return os.path.join(settings.ONNX_MODEL_DIR, model_slug(model_name))
+
+
+def _has_weights(model_dir: str) -> bool:
+    return any(os.path.exists(os.path.join(model_dir, name)) for name in WEIGHT_FILES)
+
+
+def resolve_model_dir(model_name_or_path: str) -> str:
+    """
+    Локальный каталог модели без сетевых запросов: сам путь, затем
+    LOCAL_MODEL_DIR/<модель>, затем кэш Hugging Face Hub. Скачивание из хаба
+    разрешено только при MODEL_LOCAL_FILES_ONLY=False.
+    """
+    candidates = [model_name_or_path, os.path.join(settings.LOCAL_MODEL_DIR, model_slug(model_name_or_path))]
+    for candidate in candidates:
+        if os.path.isdir(candidate):
+            if _has_weights(candidate):
+                return candidate
+            logger.warning(f"В каталоге модели {candidate} нет весов, он пропущен")
+    from huggingface_hub import snapshot_download
+    try:
+        return snapshot_download(model_name_or_path, local_files_only=settings.MODEL_LOCAL_FILES_ONLY)
+    except Exception as e:
+        raise RuntimeError(
+            f"Модель {model_name_or_path} не найдена локально. Положите её в "
+            f"{candidates[1]} или загрузите один раз с MODEL_LOCAL_FILES_ONLY=False"
+        ) from e
+
+
+def _model_normalizes(model_dir: str) -> bool:
+    """Есть ли в пайплайне sentence-transformers слой Normalize."""
+    modules_path = os.path.join(model_dir, "modules.json")
+    if not os.path.exists(modules_path):
+        return False
+    with open(modules_path, encoding="utf-8") as f:
+        return any(module.get("type", "").endswith("Normalize") for module in json.load(f))
+
+
+def _max_seq_length(model_dir: str, default: int = 256) -> int:
+    config_path = os.path.join(model_dir, "sentence_bert_config.json")
+    if not os.path.exists(config_path):
+        return default
+    with open(config_path, encoding="utf-8") as f:
+        return json.load(f).get("max_seq_length", default)
+
+
+def export_onnx_model(model_name: str, output_dir: Optional[str] = None) -> str:
+    """
+    Экспортирует трансформер модели в ONNX и квантует веса в int8 (динамическая квантизация).
+    Возвращает каталог с моделью, токенизатором и описанием пулинга.
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel, AutoTokenizer
+
+    source_dir = resolve_model_dir(model_name)
+    output_dir = output_dir or onnx_model_dir(model_name)
+    os.makedirs(output_dir, exist_ok=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(source_dir)
+    model = AutoModel.from_pretrained(source_dir).eval()
+
+    class _LastHiddenState(torch.nn.Module):
+        def __init__(self, transformer):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.transformer(input_ids=input_ids, attention_mask=attention_mask,
+                                    token_type_ids=token_type_ids)[0]
+
+    sample = tokenizer(["пример текста для экспорта"], return_tensors="pt")
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    fp32_path = os.path.join(output_dir, FP32_MODEL)
+    torch.onnx.export(
+        _LastHiddenState(model),
+        tuple(sample[name] for name in input_names),
+        fp32_path,
+        input_names=input_names,
+        output_names=["last_hidden_state"],
+        dynamic_axes={name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]},
+        opset_version=14
+    )
+    quantize_dynamic(fp32_path, os.path.join(output_dir, INT8_MODEL), weight_type=QuantType.QInt8)
+
+    tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, BACKEND_CONFIG), "w", encoding="utf-8") as f:
+        json.dump({
+            "source_model": model_name,
+            "pooling": "mean",
+            "normalize": _model_normalizes(source_dir),
+            "max_length": _max_seq_length(source_dir)
+        }, f, ensure_ascii=False, indent=2)
+    # Новый экспорт обнуляет результат прошлой проверки совпадения
+    parity_path = os.path.join(output_dir, PARITY_RECORD)
+    if os.path.exists(parity_path):
+        shutil.move(parity_path, f"{parity_path}.old")
+    logger.info(f"Модель {model_name} экспортирована в ONNX int8: {output_dir}")
+    return output_dir
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Эмбеддинги sentence-transformers через int8-квантованную сессию ONNX Runtime на CPU.
+
+    Тексты токенизируются один раз, сортируются по длине в токенах и кодируются
+    пакетами по batch_size, так что паддинг внутри пакета минимален.
+    """
+
+    def __init__(self, model_dir: str, batch_size: int = 32, intra_op_threads: int = 0,
+                 inter_op_threads: int = 1):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, BACKEND_CONFIG), encoding="utf-8") as f:
+            self.config = json.load(f)
+        self.batch_size = batch_size
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.no_padding()
+        self.tokenizer.enable_truncation(max_length=self.config["max_length"])
+        self.pad_id = self.tokenizer.token_to_id("[PAD]") or 0
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, INT8_MODEL), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def _encode_batch(self, encodings) -> np.ndarray:
+        length = max(len(encoding.ids) for encoding in encodings)
+        input_ids = np.full((len(encodings), length), self.pad_id, dtype=np.int64)
+        attention_mask = np.zeros((len(encodings), length), dtype=np.int64)
+        for row, encoding in enumerate(encodings):
+            input_ids[row, :len(encoding.ids)] = encoding.ids
+            attention_mask[row, :len(encoding.ids)] = 1
+        feeds = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": np.zeros_like(input_ids)
+        }
+        hidden = self.session.run(None, {name: value for name, value in feeds.items() if name in self.input_names})[0]
+
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.config.get("normalize"):
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled
+
+    def embed_array(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        encodings = self.tokenizer.encode_batch(texts)
+        order = sorted(range(len(texts)), key=lambda index: len(encodings[index].ids))
+        result = None
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            vectors = self._encode_batch([encodings[index] for index in batch])
+            if result is None:
+                result = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+            result[batch] = vectors
+        return result
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_array(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_array([text])[0].tolist()
+
+
+def load_parity_record(model_dir: str) -> Optional[Dict]:
+    path = os.path.join(model_dir, PARITY_RECORD)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_parity_record(model_dir: str, record: Dict) -> None:
+    record = dict(record, created_at=datetime.utcnow().isoformat())
+    with open(os.path.join(model_dir, PARITY_RECORD), "w", encoding="utf-8") as f:
+        json.dump(record, f, ensure_ascii=False, indent=2)
+
+
+def create_torch_embeddings(model_name: str) -> Embeddings:
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(
+        model_name=resolve_model_dir(model_name),
+        model_kwargs={"local_files_only": True},
+        encode_kwargs={"batch_size": settings.EMBEDDING_BATCH_SIZE}
+    )
+
+
+def _onnx_parity_record(model_name: str) -> Optional[Dict]:
+    """Запись успешной проверки совпадения ONNX-модели с PyTorch, если бэкенд ONNX включён."""
+    if settings.EMBEDDING_BACKEND != "onnx":
+        return None
+    record = load_parity_record(onnx_model_dir(model_name))
+    if record and record.get("passed") and record.get("model") == model_name:
+        return record
+    return None
+
+
+def embedding_model_id(model_name: str) -> str:
+    """Идентификатор модели для ключей кэшей и путей индексов — без загрузки бэкенда."""
+    return f"{model_name}@onnx-int8" if _onnx_parity_record(model_name) else model_name
+
+
+def create_embeddings(model_name: str) -> Tuple[Embeddings, str]:
+    """
+    Создаёт бэкенд эмбеддингов по settings.EMBEDDING_BACKEND. Возвращает модель и её
+    идентификатор для ключей кэшей. ONNX используется только при записанной и успешной
+    проверке совпадения с PyTorch (см. embedding_benchmark.py), иначе — PyTorch.
+    """
+    if settings.EMBEDDING_BACKEND == "onnx":
+        model_dir = onnx_model_dir(model_name)
+        record = _onnx_parity_record(model_name)
+        if record:
+            logger.info(f"Эмбеддинги через ONNX int8: {model_dir} "
+                        f"(косинус с PyTorch не ниже {record['min_cosine']:.4f})")
+            embeddings = OnnxEmbeddings(
+                model_dir,
+                batch_size=settings.EMBEDDING_BATCH_SIZE,
+                intra_op_threads=settings.EMBEDDING_INTRA_OP_THREADS,
+                inter_op_threads=settings.EMBEDDING_INTER_OP_THREADS
+            )
+            return embeddings, embedding_model_id(model_name)
+        logger.warning(f"Нет успешной проверки совпадения ONNX-модели в {model_dir}, используется PyTorch")
+    return create_torch_embeddings(model_name), model_name
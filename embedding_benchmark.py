@@ -0,0 +1,97 @@
+"""
+Проверка совпадения ONNX int8-бэкенда эмбеддингов с PyTorch и замер пропускной способности.
+
+Пример:
+    python embedding_benchmark.py --export --files references/*.pdf
+
+Результат записывается в <ONNX_MODEL_DIR>/<модель>/parity.json; без успешной записи
+EMBEDDING_BACKEND=onnx не включается.
+"""
+import argparse
+import glob
+import logging
+import os
+import time
+
+import numpy as np
+
+from config import settings
+from document_loader import extract_document
+from embedding_backends import (INT8_MODEL, OnnxEmbeddings, create_torch_embeddings, export_onnx_model,
+                                onnx_model_dir, save_parity_record)
+
+logger = logging.getLogger(__name__)
+
+
+def collect_chunks(patterns, limit: int):
+    chunks = []
+    for pattern in patterns:
+        for file_path in sorted(glob.glob(pattern)):
+            document = extract_document(file_path)
+            if document is None:
+                continue
+            for start, end in document.chunks(1200, 300):
+                chunk = " ".join(document.text[start:end].split())
+                if chunk:
+                    chunks.append(chunk)
+                if len(chunks) >= limit:
+                    return chunks
+    return chunks
+
+
+def measure(embed, texts):
+    start = time.perf_counter()
+    vectors = np.asarray(embed(texts), dtype=np.float32)
+    return vectors, len(texts) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=settings.EMBEDDING_MODEL)
+    parser.add_argument("--files", nargs="+", default=["references/*.pdf"])
+    parser.add_argument("--limit", type=int, default=512, help="максимум чанков в выборке")
+    parser.add_argument("--batch-size", type=int, default=settings.EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=settings.EMBEDDING_INTRA_OP_THREADS)
+    parser.add_argument("--min-cosine", type=float, default=settings.EMBEDDING_PARITY_MIN_COSINE)
+    parser.add_argument("--export", action="store_true", help="переэкспортировать модель в ONNX")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    model_dir = onnx_model_dir(args.model)
+    if args.export or not os.path.exists(os.path.join(model_dir, INT8_MODEL)):
+        export_onnx_model(args.model, model_dir)
+
+    chunks = collect_chunks(args.files, args.limit)
+    if not chunks:
+        raise SystemExit("Не найдено текстов для проверки")
+
+    torch_vectors, torch_rate = measure(create_torch_embeddings(args.model).embed_documents, chunks)
+    onnx_embeddings = OnnxEmbeddings(model_dir, batch_size=args.batch_size, intra_op_threads=args.threads,
+                                     inter_op_threads=settings.EMBEDDING_INTER_OP_THREADS)
+    onnx_vectors, onnx_rate = measure(onnx_embeddings.embed_array, chunks)
+
+    norms = np.linalg.norm(torch_vectors, axis=1) * np.linalg.norm(onnx_vectors, axis=1)
+    cosines = (torch_vectors * onnx_vectors).sum(axis=1) / np.clip(norms, 1e-12, None)
+    record = {
+        "model": args.model,
+        "chunks": len(chunks),
+        "min_cosine": float(cosines.min()),
+        "mean_cosine": float(cosines.mean()),
+        "threshold": args.min_cosine,
+        "passed": bool(cosines.min() >= args.min_cosine),
+        "torch_chunks_per_sec": round(torch_rate, 2),
+        "onnx_chunks_per_sec": round(onnx_rate, 2),
+        "batch_size": args.batch_size,
+        "intra_op_threads": args.threads
+    }
+    save_parity_record(model_dir, record)
+
+    print(f"Чанков: {len(chunks)}")
+    print(f"Косинус ONNX/PyTorch: min {record['min_cosine']:.5f}, mean {record['mean_cosine']:.5f} "
+          f"(порог {args.min_cosine}) -> {'OK' if record['passed'] else 'FAIL'}")
+    print(f"PyTorch: {torch_rate:.1f} чанков/с, ONNX int8: {onnx_rate:.1f} чанков/с "
+          f"(x{onnx_rate / torch_rate:.2f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from filelock import FileLock
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 16
+
+
+def chunk_hash(text: str) -> bytes:
+    """Хэш нормализованного чанка: пробельные символы схлопываются, края обрезаются."""
+    normalized = re.sub(r'\s+', ' ', text).strip()
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=HASH_SIZE).digest()
+
+
+class EmbeddingCache:
+    """
+    Кэш эмбеддингов чанков для одной модели.
+
+    Векторы лежат в отображённой в память матрице фиксированной ёмкости
+    (max_bytes / размер вектора), рядом — матрица хэшей строк. Индекс хэш -> строка
+    хранится в памяти в порядке LRU; при заполнении вытесняется самая старая строка.
+    Запись идёт под файловой блокировкой, а чтение сверяет хэш строки, поэтому
+    несколько процессов могут работать с одним каталогом.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, dtype: str = "float16"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(os.path.join(directory, "cache.lock"))
+        self._meta_path = os.path.join(directory, "meta.json")
+        self._order_path = os.path.join(directory, "lru_order.npy")
+        self._vectors: Optional[np.memmap] = None
+        self._row_hashes: Optional[np.memmap] = None
+        self._rows: "OrderedDict[bytes, int]" = OrderedDict()
+        self._free_rows: List[int] = []
+        self._generation = 0
+        self.dim: Optional[int] = None
+        self.capacity = 0
+        os.makedirs(directory, exist_ok=True)
+        with self._file_lock:
+            self._load()
+
+    def _read_meta(self) -> Optional[Dict]:
+        if not os.path.exists(self._meta_path):
+            return None
+        with open(self._meta_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _open_matrices(self, dim: int, capacity: int, create: bool) -> None:
+        mode = "w+" if create else "r+"
+        self._vectors = np.memmap(os.path.join(self.directory, f"vectors.{self.dtype.name}"),
+                                  dtype=self.dtype, mode=mode, shape=(capacity, dim))
+        self._row_hashes = np.memmap(os.path.join(self.directory, "row_hashes.bin"),
+                                     dtype=np.uint8, mode=mode, shape=(capacity, HASH_SIZE))
+        self.dim = dim
+        self.capacity = capacity
+
+    def _load(self) -> None:
+        """Загружает индекс с диска (вызывается под файловой блокировкой)."""
+        meta = self._read_meta()
+        if not meta or meta.get("dtype") != self.dtype.name:
+            return
+        if self._vectors is None or meta["dim"] != self.dim or meta["capacity"] != self.capacity:
+            self._open_matrices(meta["dim"], meta["capacity"], create=False)
+        order = np.load(self._order_path) if os.path.exists(self._order_path) else np.empty(0, dtype=np.int64)
+        self._rows = OrderedDict((self._row_hashes[row].tobytes(), int(row)) for row in order)
+        used = set(self._rows.values())
+        self._free_rows = [row for row in range(self.capacity - 1, -1, -1) if row not in used]
+        self._generation = meta.get("generation", 0)
+
+    def _save(self) -> None:
+        self._vectors.flush()
+        self._row_hashes.flush()
+        # Порядок LRU и meta.json пишутся во временные файлы и атомарно подменяются
+        tmp_path = f"{self._order_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.fromiter(self._rows.values(), dtype=np.int64, count=len(self._rows)))
+        os.replace(tmp_path, self._order_path)
+        self._generation += 1
+        tmp_path = f"{self._meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "capacity": self.capacity, "dtype": self.dtype.name,
+                       "generation": self._generation}, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _reload_if_changed(self) -> None:
+        """Перечитывает индекс, если другой процесс сохранил кэш после нашей загрузки."""
+        try:
+            meta = self._read_meta()
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка чтения метаданных кэша эмбеддингов: {str(e)}")
+            return
+        if meta and meta.get("generation", 0) != self._generation:
+            with self._file_lock:
+                self._load()
+
+    def get_many(self, hashes: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """Возвращает найденные в кэше векторы (float32) по хэшам чанков."""
+        found = {}
+        with self._lock:
+            self._reload_if_changed()
+            if self._vectors is None:
+                self.misses += len(hashes)
+                return found
+            for key in hashes:
+                row = self._rows.get(key)
+                # Строку могли переиспользовать в другом процессе — сверяем хэш
+                if row is not None and self._row_hashes[row].tobytes() == key:
+                    self._rows.move_to_end(key)
+                    found[key] = np.asarray(self._vectors[row], dtype=np.float32)
+            self.hits += len(found)
+            self.misses += len(hashes) - len(found)
+        return found
+
+    def put_many(self, hashes: List[bytes], vectors: np.ndarray) -> None:
+        """Сохраняет новые векторы, вытесняя давно не использованные строки."""
+        if not hashes:
+            return
+        with self._lock, self._file_lock:
+            meta = self._read_meta()
+            if meta and meta.get("generation", 0) != self._generation:
+                self._load()
+            if self._vectors is None:
+                dim = vectors.shape[1]
+                capacity = max(1, self.max_bytes // (dim * self.dtype.itemsize))
+                self._open_matrices(dim, capacity, create=True)
+                self._free_rows = list(range(capacity - 1, -1, -1))
+            for key, vector in zip(hashes, vectors):
+                row = self._rows.pop(key, None)
+                if row is None:
+                    if self._free_rows:
+                        row = self._free_rows.pop()
+                    else:
+                        _, row = self._rows.popitem(last=False)
+                self._vectors[row] = vector
+                self._row_hashes[row] = np.frombuffer(key, dtype=np.uint8)
+                self._rows[key] = row
+            self._save()
+
+    def stats(self) -> Dict:
+        """Заполненность кэша и счётчики попаданий в этом процессе."""
+        return {"rows": len(self._rows), "capacity": self.capacity, "hits": self.hits, "misses": self.misses}
+
+
+class CachedEmbeddings(Embeddings):
+    """Обёртка над моделью эмбеддингов: кодируются только чанки, которых нет в кэше."""
+
+    def __init__(self, base: Embeddings, cache: EmbeddingCache):
+        self.base = base
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [chunk_hash(text) for text in texts]
+        found = self.cache.get_many(list(dict.fromkeys(hashes)))
+
+        # Новые чанки кодируем одним пакетом, повторы внутри пакета — один раз
+        missing: Dict[bytes, str] = {}
+        for key, text in zip(hashes, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            encoded = np.asarray(self.base.embed_documents(list(missing.values())), dtype=np.float32)
+            self.cache.put_many(list(missing.keys()), encoded)
+            found.update(zip(missing.keys(), encoded))
+        logger.info(f"Эмбеддинги чанков: {len(texts)} всего, {len(missing)} закодировано заново")
+        return [found[key].tolist() for key in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.base.embed_query(text)
+
+    def embed_queries(self, texts: List[str]) -> np.ndarray:
+        """Кодирует запросы одним пакетом в обход кэша (запросы не переиспользуются)."""
+        return np.asarray(self.base.embed_documents(texts), dtype=np.float32)
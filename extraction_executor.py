@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+from config import settings
+from document_loader import DocumentLoader, count_pdf_pages, extract_document, extract_pdf_page_range
+from document_model import StructuredDocument
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractionQueueFullError(RuntimeError):
+    """Очередь извлечения переполнена."""
+
+
+class ExtractionExecutor:
+    """
+    Пул процессов для синхронного извлечения текста (textract, antiword, декодирование),
+    чтобы тяжёлые документы не блокировали event loop.
+
+    Одновременно в работе не больше max_workers задач, ещё queue_size ждут свободного
+    процесса; остальные сразу отклоняются с ExtractionQueueFullError. Большие PDF
+    делятся на диапазоны страниц, которые извлекаются параллельно в том же пуле.
+    """
+
+    def __init__(self, max_workers: int, timeout: float, queue_size: int,
+                 large_pdf_min_pages: int, pdf_page_range_size: int):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.large_pdf_min_pages = large_pdf_min_pages
+        self.pdf_page_range_size = pdf_page_range_size
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+        self._slots = asyncio.Semaphore(max_workers + queue_size)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                logger.info(f"Запуск пула извлечения текста: {self.max_workers} процессов")
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._pool
+
+    def _restart_pool(self, pool: ProcessPoolExecutor) -> None:
+        """Останавливает зависший пул; следующий вызов создаст новый."""
+        with self._pool_lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+        for process in list((pool._processes or {}).values()):
+            if process.is_alive():
+                process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _submit(self, func: Callable[..., Any], *args: Any, timeout: Optional[float] = None) -> Any:
+        """Отправляет задачу в пул без проверки очереди (для подзадач уже принятой задачи)."""
+        timeout = timeout or self.timeout
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            pool = self._get_pool()
+            try:
+                return await asyncio.wait_for(loop.run_in_executor(pool, func, *args), timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"Превышено время извлечения ({timeout} с) для {args}")
+                self._restart_pool(pool)
+                raise TimeoutError(f"Превышено время извлечения текста ({timeout} с)")
+            except BrokenProcessPool:
+                # Пул перезапущен из-за зависшей задачи соседа — повторяем один раз
+                self._restart_pool(pool)
+                if attempt:
+                    raise
+                logger.warning(f"Пул извлечения перезапущен, повтор задачи {args}")
+
+    def _check_queue(self) -> None:
+        if self._slots.locked():
+            raise ExtractionQueueFullError("Очередь извлечения текста переполнена, повторите позже")
+
+    async def run(self, func: Callable[..., Any], *args: Any, timeout: Optional[float] = None) -> Any:
+        """Выполняет func(*args) в пуле процессов с ограничением очереди и таймаутом."""
+        self._check_queue()
+        async with self._slots:
+            return await self._submit(func, *args, timeout=timeout)
+
+    async def _extract_large_pdf(self, file_path: str, page_count: int) -> Optional[StructuredDocument]:
+        """Извлекает PDF диапазонами страниц параллельно и собирает их по порядку."""
+        range_size = self.pdf_page_range_size
+        ranges = [(start, min(start + range_size, page_count)) for start in range(0, page_count, range_size)]
+        logger.info(f"Параллельное извлечение PDF {file_path}: {page_count} страниц, {len(ranges)} диапазонов")
+        chunks = await asyncio.gather(*(
+            self._submit(extract_pdf_page_range, file_path, start, end) for start, end in ranges
+        ))
+        pages = [page for chunk in chunks for page in chunk]
+        text, layout = DocumentLoader().assemble_pages(pages)
+        if not text.strip():
+            return None
+        return await asyncio.to_thread(StructuredDocument.build, text, layout)
+
+    async def extract(self, file_path: str) -> Optional[StructuredDocument]:
+        self._check_queue()
+        async with self._slots:
+            if file_path.lower().endswith('.pdf'):
+                try:
+                    page_count = await self._submit(count_pdf_pages, file_path)
+                except (TimeoutError, BrokenProcessPool):
+                    raise
+                except Exception as e:
+                    logger.warning(f"Не удалось определить число страниц {file_path}: {str(e)}")
+                    page_count = 0
+                if page_count >= self.large_pdf_min_pages:
+                    return await self._extract_large_pdf(file_path, page_count)
+            return await self._submit(extract_document, file_path)
+
+    def shutdown(self) -> None:
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+extraction_executor = ExtractionExecutor(
+    max_workers=settings.EXTRACTION_WORKERS,
+    timeout=settings.EXTRACTION_TIMEOUT,
+    queue_size=settings.EXTRACTION_QUEUE_SIZE,
+    large_pdf_min_pages=settings.LARGE_PDF_MIN_PAGES,
+    pdf_page_range_size=settings.PDF_PAGE_RANGE_SIZE
+)
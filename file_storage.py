@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from typing import BinaryIO, Optional, Tuple
+
+from fastapi import UploadFile
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from database import UploadedFile
+
+logger = logging.getLogger(__name__)
+
+
+class FileTooLargeError(ValueError):
+    """Размер загружаемого файла превышает settings.MAX_FILE_SIZE."""
+
+
+def _copy_stream(source: BinaryIO, target: Optional[BinaryIO], max_size: int, chunk_size: int) -> Tuple[int, str]:
+    """Копирует поток блоками, считая MD5 и размер на лету (без target — только считает)."""
+    md5_hash = hashlib.md5()
+    size = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise FileTooLargeError("Размер файла превышает допустимый предел")
+        md5_hash.update(chunk)
+        if target is not None:
+            target.write(chunk)
+    return size, md5_hash.hexdigest()
+
+
+async def spool_upload(file: UploadFile, directory: str, max_size: int = settings.MAX_FILE_SIZE,
+                       chunk_size: int = settings.UPLOAD_CHUNK_SIZE) -> Tuple[str, int, str]:
+    """
+    Записывает загрузку во временный файл в directory за один проход: MD5 и
+    лимит размера проверяются по ходу записи. Возвращает (путь, размер, md5);
+    временный файл затем публикуется commit_blob или удаляется discard_spooled.
+    """
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as target:
+            await asyncio.to_thread(file.file.seek, 0)
+            size, md5_hash = await asyncio.to_thread(_copy_stream, file.file, target, max_size, chunk_size)
+    except BaseException:
+        discard_spooled(tmp_path)
+        raise
+    return tmp_path, size, md5_hash
+
+
+def discard_spooled(tmp_path: str) -> None:
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+
+def blob_stored_name(md5_hash: str, extension: str) -> str:
+    """Путь блоба относительно UPLOAD_DIR: один файл на хэш, шардирование по первым байтам."""
+    return os.path.join(md5_hash[:2], md5_hash[2:4], f"{md5_hash}{extension.lower()}")
+
+
+def commit_blob(tmp_path: str, upload_dir: str, md5_hash: str, extension: str) -> Tuple[str, bool]:
+    """
+    Публикует записанный spool_upload файл как блоб, если блоба с таким хэшем
+    ещё нет. Жёсткая ссылка создаётся атомарно, поэтому из параллельных
+    загрузок одного содержимого блоб создаёт ровно одна. Возвращает
+    (stored_name, создан ли блоб этим вызовом); временный файл удаляется.
+    """
+    stored_name = blob_stored_name(md5_hash, extension)
+    blob_path = os.path.join(upload_dir, stored_name)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    try:
+        os.link(tmp_path, blob_path)
+        created = True
+    except FileExistsError:
+        created = False
+    except OSError:
+        # Файловая система без жёстких ссылок
+        created = not os.path.exists(blob_path)
+        if created:
+            os.replace(tmp_path, blob_path)
+    finally:
+        discard_spooled(tmp_path)
+    if created:
+        logger.info(f"Блоб {stored_name} сохранён")
+    else:
+        logger.info(f"Блоб {stored_name} уже существует, запись пропущена")
+    return stored_name, created
+
+
+async def release_blob(db: AsyncSession, upload_dir: str, stored_name: str) -> bool:
+    """Удаляет блоб с диска, если на него не ссылается ни одна неудалённая запись."""
+    query = select(func.count()).select_from(UploadedFile).where(
+        UploadedFile.stored_name == stored_name, UploadedFile.is_deleted == False
+    )
+    if (await db.execute(query)).scalar():
+        return False
+    blob_path = os.path.join(upload_dir, stored_name)
+    if not os.path.exists(blob_path):
+        return False
+    os.remove(blob_path)
+    # Убираем опустевшие каталоги шардов
+    shard_dir = os.path.dirname(blob_path)
+    while shard_dir and os.path.abspath(shard_dir) != os.path.abspath(upload_dir):
+        try:
+            os.rmdir(shard_dir)
+        except OSError:
+            break
+        shard_dir = os.path.dirname(shard_dir)
+    logger.info(f"Блоб {stored_name} освобождён")
+    return True
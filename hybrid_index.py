@@ -0,0 +1,179 @@
+import logging
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r'\w+')
+_CYRILLIC_RE = re.compile(r'^[а-я]+$')
+
+STOP_WORDS = frozenset("""
+а без более бы был была были было быть в вам вас весь во вот все всего всех вы где да даже для до его ее ей ему
+если есть еще же за и из или им их к как ко когда кто ли либо между меня мне может мы на над надо не него нее
+нет ни них но ну о об однако он она они оно от по под при с со так также такой там те тем то того тоже той
+только том ту ты у уже хотя чем через что чтобы эта эти это этот я
+a an and are as at be by for from in is it of on or that the this to with
+""".split())
+
+# Окончания для лёгкого стемминга русских слов (от длинных к коротким)
+_REFLEXIVE = ("ся", "сь")
+_ENDINGS = tuple(sorted({
+    "ыми", "ими", "его", "ого", "ему", "ому", "ее", "ие", "ые", "ое", "ей", "ий", "ый", "ой", "ем", "им", "ым",
+    "ом", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею",
+    "ать", "ять", "ить", "еть", "уть", "ешь", "ет", "ют", "ут", "ат", "ят", "ит", "ете", "ите", "ла", "ло", "ли",
+    "ть", "ами", "ями", "ах", "ях", "ов", "ев", "ам", "ям", "ия", "ию", "ии", "ием", "ией", "иям", "иями", "иях",
+    "а", "я", "о", "е", "и", "ы", "у", "ю", "ь"
+}, key=len, reverse=True))
+_MIN_STEM = 3
+
+
+def stem(word: str) -> str:
+    """
+    Отрезает типичное окончание русского слова, оставляя основу не короче трёх букв.
+    Все падежные формы существительного сводятся к одной основе:
+
+    >>> sorted({stem(word) for word in (
+    ...     "требование", "требования", "требованию", "требованием", "требовании",
+    ...     "требований", "требованиям", "требованиями", "требованиях")})
+    ['требован']
+    >>> sorted({stem(word) for word in (
+    ...     "функция", "функции", "функцию", "функцией",
+    ...     "функций", "функциям", "функциями", "функциях")})
+    ['функц']
+    """
+    if len(word) <= _MIN_STEM or not _CYRILLIC_RE.match(word):
+        return word
+    for ending in _REFLEXIVE:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM:
+            word = word[:-len(ending)]
+            break
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Токены для лексического поиска: нижний регистр, ё -> е, без стоп-слов, со стеммингом."""
+    tokens = []
+    for word in _TOKEN_RE.findall(text.lower().replace("ё", "е")):
+        if len(word) < 2 or word in STOP_WORDS:
+            continue
+        tokens.append(stem(word))
+    return tokens
+
+
+class HybridIndex:
+    """
+    Гибридный индекс чанков одного документа: BM25 по инвертированному индексу
+    и векторный поиск по FAISS, объединённые взвешенным reciprocal rank fusion.
+
+    Позиция чанка совпадает с позицией вектора в FAISS-индексе. Веса BM25 для
+    каждой пары (термин, чанк) и множества терминов чанков считаются при
+    построении, поэтому запрос — это сложение нескольких numpy-массивов,
+    а проверка покрытия — пересечение множеств.
+    """
+
+    RRF_K = 60
+
+    def __init__(self, chunks: List[Dict], vectorstore=None, k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.vectorstore = vectorstore
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self.token_sets: List[frozenset] = []
+
+        term_counts: Dict[str, Dict[int, int]] = {}
+        lengths = np.zeros(len(chunks), dtype=np.float32)
+        for position, chunk in enumerate(chunks):
+            tokens = tokenize(chunk["content"])
+            lengths[position] = len(tokens)
+            self.token_sets.append(frozenset(tokens))
+            for token in tokens:
+                counts = term_counts.setdefault(token, {})
+                counts[position] = counts.get(position, 0) + 1
+
+        average_length = float(lengths.mean()) if len(chunks) and lengths.mean() > 0 else 1.0
+        for term, counts in term_counts.items():
+            ids = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+            tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+            idf = np.log(1 + (len(chunks) - len(ids) + 0.5) / (len(ids) + 0.5))
+            weights = idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[ids] / average_length))
+            self.postings[term] = (ids, weights.astype(np.float32))
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore) -> "HybridIndex":
+        """Строит лексическую часть по чанкам из docstore FAISS-индекса (в порядке векторов)."""
+        chunks = []
+        for position in range(len(vectorstore.index_to_docstore_id)):
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[position])
+            chunks.append({
+                "chunk_id": doc.metadata.get("chunk_id", position + 1),
+                "content": doc.page_content,
+                "start": doc.metadata.get("start", 0),
+                "end": doc.metadata.get("end", 0)
+            })
+        return cls(chunks, vectorstore)
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def bm25_scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is not None:
+                scores[posting[0]] += posting[1]
+        return scores
+
+    def term_coverage(self, query: str, position: int) -> float:
+        """Доля различных терминов запроса, встречающихся в чанке."""
+        terms = set(tokenize(query))
+        if not terms:
+            return 0.0
+        return len(terms & self.token_sets[position]) / len(terms)
+
+    def _vector_ranks(self, query_vectors: np.ndarray, candidates: int) -> np.ndarray:
+        """Позиции ближайших чанков для каждого запроса одним матричным поиском FAISS."""
+        if self.vectorstore is None:
+            return np.full((len(query_vectors), 0), -1, dtype=np.int64)
+        _, indices = self.vectorstore.index.search(np.ascontiguousarray(query_vectors, dtype=np.float32), candidates)
+        return indices
+
+    def search_many(self, queries: Sequence[str], query_vectors: Optional[np.ndarray] = None,
+                    k: int = 5, alpha: float = None) -> List[List[Tuple[int, float]]]:
+        """
+        Для каждого запроса возвращает до k пар (позиция чанка, итоговый балл)
+        по убыванию балла. alpha — вес векторного ранга, 1 - alpha — вес BM25.
+        Без query_vectors поиск чисто лексический.
+        """
+        alpha = settings.HYBRID_ALPHA if alpha is None else alpha
+        k = min(k, len(self.chunks))
+        if k <= 0:
+            return [[] for _ in queries]
+        candidates = min(max(k, settings.HYBRID_CANDIDATES), len(self.chunks))
+        vector_ranks = self._vector_ranks(query_vectors, candidates) if query_vectors is not None else None
+
+        results = []
+        for row, query in enumerate(queries):
+            fused: Dict[int, float] = {}
+            bm25 = self.bm25_scores(query)
+            if bm25.any():
+                top = np.argpartition(-bm25, candidates - 1)[:candidates]
+                top = top[bm25[top] > 0]
+                for rank, position in enumerate(top[np.argsort(-bm25[top], kind="stable")]):
+                    fused[int(position)] = (1 - alpha) / (self.RRF_K + rank + 1)
+            if vector_ranks is not None:
+                for rank, position in enumerate(vector_ranks[row]):
+                    if position >= 0:
+                        fused[int(position)] = fused.get(int(position), 0.0) + alpha / (self.RRF_K + rank + 1)
+            results.append(sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k])
+        return results
+
+    def search(self, query: str, query_vector: Optional[np.ndarray] = None, k: int = 5,
+               alpha: float = None) -> List[Tuple[int, float]]:
+        vectors = None if query_vector is None else np.asarray(query_vector, dtype=np.float32).reshape(1, -1)
+        return self.search_many([query], vectors, k, alpha)[0]
@@ -1,14 +1,13 @@
 import asyncio
-from database import Base, engine
+from database import create_tables, engine
 import logging
 
 async def init_db():
     logging.basicConfig(level=logging.INFO)
     logging.info("Создание таблиц базы данных...")
     
-    # Создаем все таблицы
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # Создаем все таблицы и добавляем новые колонки в существующие
+    await create_tables(engine)
     
     logging.info("База данных успешно инициализирована!")
 
@@ -0,0 +1,233 @@
+import hashlib
+import logging
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Секунды из значения заголовка Groq: «7.66s», «2m59.56s», «150ms» или просто число."""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def parse_rate_limit_headers(headers: Optional[Mapping[str, str]]) -> Dict[str, float]:
+    """
+    Остаток лимитов и время до сброса из заголовков ответа:
+    retry-after, x-ratelimit-remaining-{requests,tokens}, x-ratelimit-reset-{requests,tokens}.
+    """
+    info: Dict[str, float] = {}
+    if not headers:
+        return info
+    headers = {name.lower(): value for name, value in headers.items()}
+    for name in ("requests", "tokens"):
+        remaining = headers.get(f"x-ratelimit-remaining-{name}")
+        if remaining is not None:
+            try:
+                info[f"remaining_{name}"] = float(remaining)
+            except ValueError:
+                pass
+    waits = []
+    if "retry-after" in headers:
+        waits.append(parse_duration(headers["retry-after"]))
+    # Сброс лимита важен, только если он исчерпан
+    for name in ("requests", "tokens"):
+        if info.get(f"remaining_{name}") == 0 and f"x-ratelimit-reset-{name}" in headers:
+            waits.append(parse_duration(headers[f"x-ratelimit-reset-{name}"]))
+    waits = [wait for wait in waits if wait is not None]
+    if waits:
+        info["retry_after"] = max(waits)
+    return info
+
+
+def error_headers(error: Exception) -> Optional[Mapping[str, str]]:
+    """Заголовки HTTP-ответа из исключения клиента Groq (APIStatusError.response)."""
+    return getattr(getattr(error, "response", None), "headers", None)
+
+
+class KeyPool:
+    """
+    Планировщик API-ключей с двумя корзинами токенов на ключ: запросы в минуту
+    и токены в минуту. Запрос получает ключ с наибольшим остатком бюджета;
+    ключ, получивший 429/413, откладывается на retry-after из заголовков или на
+    ограниченную экспоненциальную задержку со случайным разбросом.
+
+    Состояние корзин хранится в SQLite (KEY_POOL_DB_PATH) и меняется в
+    транзакциях BEGIN IMMEDIATE, поэтому все воркеры uvicorn на машине делят
+    один бюджет ключей. Сами ключи не сохраняются — только их хэши.
+    """
+
+    def __init__(self, keys: List[str], path: str, requests_per_minute: int, tokens_per_minute: int,
+                 base_delay: float, max_delay: float):
+        self.key_ids = [hashlib.sha256(key.strip().encode("utf-8")).hexdigest()[:16] for key in keys]
+        self.path = path
+        self.requests_per_minute = float(requests_per_minute)
+        self.tokens_per_minute = float(tokens_per_minute)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.key_ids)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS key_state (
+                    key_id TEXT PRIMARY KEY,
+                    requests REAL NOT NULL,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    blocked_until REAL NOT NULL DEFAULT 0,
+                    failures INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self._connection = connection
+        return self._connection
+
+    def _update(self, change) -> object:
+        """
+        Выполняет change(states, now) в транзакции над пополненными корзинами
+        всех ключей и сохраняет их; возвращает результат change.
+        """
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                rows = {row[0]: row for row in connection.execute(
+                    "SELECT key_id, requests, tokens, updated_at, blocked_until, failures FROM key_state"
+                )}
+                states = []
+                for key_id in self.key_ids:
+                    _, requests, tokens, updated_at, blocked_until, failures = rows.get(
+                        key_id, (key_id, self.requests_per_minute, self.tokens_per_minute, now, 0.0, 0))
+                    elapsed = max(now - updated_at, 0.0) / 60
+                    states.append({
+                        "requests": min(self.requests_per_minute, requests + elapsed * self.requests_per_minute),
+                        "tokens": min(self.tokens_per_minute, tokens + elapsed * self.tokens_per_minute),
+                        "blocked_until": blocked_until,
+                        "failures": failures
+                    })
+                result = change(states, now)
+                connection.executemany(
+                    "INSERT OR REPLACE INTO key_state (key_id, requests, tokens, updated_at, blocked_until, failures) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(key_id, state["requests"], state["tokens"], now, state["blocked_until"], state["failures"])
+                     for key_id, state in zip(self.key_ids, states)]
+                )
+                connection.execute("COMMIT")
+                return result
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def try_acquire(self, tokens: float) -> Tuple[Optional[int], float]:
+        """
+        Резервирует запрос и tokens токенов на ключе с наибольшим остатком
+        бюджета. Возвращает (номер ключа, 0) или (None, секунд до появления
+        свободного ключа).
+        """
+        # Запрос больше минутного лимита иначе не прошёл бы никогда
+        tokens = min(tokens, self.tokens_per_minute)
+
+        def change(states, now):
+            best, best_budget, wait = None, -1.0, math.inf
+            for index, state in enumerate(states):
+                if state["blocked_until"] > now:
+                    wait = min(wait, state["blocked_until"] - now)
+                    continue
+                if state["requests"] >= 1 and state["tokens"] >= tokens:
+                    budget = min(state["requests"] / self.requests_per_minute, state["tokens"] / self.tokens_per_minute)
+                    if budget > best_budget:
+                        best, best_budget = index, budget
+                else:
+                    wait = min(wait, 60 * max((1 - state["requests"]) / self.requests_per_minute,
+                                              (tokens - state["tokens"]) / self.tokens_per_minute))
+            if best is None:
+                return None, wait
+            states[best]["requests"] -= 1
+            states[best]["tokens"] -= tokens
+            return best, 0.0
+
+        return self._update(change)
+
+    def record_success(self, index: int, reserved_tokens: float, used_tokens: Optional[float] = None,
+                       headers: Optional[Mapping[str, str]] = None) -> None:
+        """Возвращает в корзину разницу между оценкой и фактическим расходом токенов."""
+        info = parse_rate_limit_headers(headers)
+
+        def change(states, now):
+            state = states[index]
+            state["failures"] = 0
+            if used_tokens is not None:
+                state["tokens"] = min(self.tokens_per_minute,
+                                      state["tokens"] + min(reserved_tokens, self.tokens_per_minute) - used_tokens)
+            self._apply_headers(state, info, now)
+
+        self._update(change)
+
+    def release(self, index: int, reserved_tokens: float) -> None:
+        """
+        Возвращает в корзину резерв токенов запроса, завершившегося ошибкой
+        (не 429/413) или тайм-аутом. Сам запрос остаётся учтённым: он мог
+        дойти до API.
+        """
+        def change(states, now):
+            state = states[index]
+            state["tokens"] = min(self.tokens_per_minute,
+                                  state["tokens"] + min(reserved_tokens, self.tokens_per_minute))
+
+        self._update(change)
+
+    def penalize(self, index: int, headers: Optional[Mapping[str, str]] = None) -> float:
+        """
+        Откладывает ключ после 429/413: на время из заголовков (retry-after или
+        сброс исчерпанного лимита), иначе на
+        min(max_delay, base_delay * 2^(ошибок подряд - 1)) со случайным разбросом
+        50–100%. Возвращает задержку в секундах.
+        """
+        info = parse_rate_limit_headers(headers)
+
+        def change(states, now):
+            state = states[index]
+            state["failures"] += 1
+            delay = info.get("retry_after")
+            if delay is None:
+                delay = min(self.max_delay, self.base_delay * 2 ** (state["failures"] - 1))
+                delay *= 0.5 + random.random() / 2
+            state["blocked_until"] = max(state["blocked_until"], now + delay)
+            self._apply_headers(state, info, now)
+            return delay
+
+        return self._update(change)
+
+    @staticmethod
+    def _apply_headers(state: Dict, info: Dict[str, float], now: float) -> None:
+        if "remaining_requests" in info:
+            state["requests"] = min(state["requests"], info["remaining_requests"])
+        if "remaining_tokens" in info:
+            state["tokens"] = min(state["tokens"], info["remaining_tokens"])
+        if "retry_after" in info:
+            state["blocked_until"] = max(state["blocked_until"], now + info["retry_after"])
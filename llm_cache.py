@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.exc import IntegrityError
+
+from config import settings
+from database import AsyncSessionLocal, LLMResponse
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(model: str, prompt_version: str, prompt: str, params: Optional[Dict] = None) -> str:
+    """Ключ ответа: модель, версия шаблона промпта, параметры вызова и хэш отрендеренного промпта."""
+    payload = json.dumps({
+        "model": model,
+        "prompt_version": prompt_version,
+        "params": params or {},
+        "prompt": hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseLRUCache:
+    """LRU-кэш ответов LLM в памяти процесса с ограничением суммарного размера в байтах."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._items: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(response: str) -> int:
+        return len(response.encode("utf-8"))
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            response = self._items.get(key)
+            if response is not None:
+                self._items.move_to_end(key)
+            return response
+
+    def put(self, key: str, response: str) -> None:
+        size = self._size(response)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= self._size(previous)
+            self._items[key] = response
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.current_bytes -= self._size(evicted)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class LLMResponseCache:
+    """
+    Двухуровневый кэш ответов LLM: LRU в памяти процесса -> таблица
+    llm_responses (общая для всех воркеров) со сроком жизни LLM_CACHE_TTL_DAYS.
+    Объём таблицы ограничивается prune() по давности последнего обращения.
+    Ошибки базы не прерывают запрос — ответ просто берётся у LLM.
+    """
+
+    def __init__(self, max_memory_bytes: int, ttl: timedelta, max_db_bytes: int):
+        self.memory = ResponseLRUCache(max_memory_bytes)
+        self.ttl = ttl
+        self.max_db_bytes = max_db_bytes
+        self.counters = {"memory_hits": 0, "db_hits": 0, "misses": 0, "stores": 0, "errors": 0}
+
+    async def get(self, key: str) -> Optional[str]:
+        response = self.memory.get(key)
+        if response is not None:
+            self.counters["memory_hits"] += 1
+            return response
+        try:
+            async with AsyncSessionLocal() as db:
+                now = datetime.utcnow()
+                row = (await db.execute(
+                    select(LLMResponse).where(LLMResponse.cache_key == key, LLMResponse.created_at >= now - self.ttl)
+                )).scalar_one_or_none()
+                if row is not None:
+                    response = row.response
+                    row.hits += 1
+                    row.last_used_at = now
+                    await db.commit()
+        except Exception as e:
+            self.counters["errors"] += 1
+            logger.error(f"Ошибка чтения кэша ответов LLM: {str(e)}")
+            response = None
+        if response is None:
+            self.counters["misses"] += 1
+            return None
+        self.counters["db_hits"] += 1
+        self.memory.put(key, response)
+        return response
+
+    async def put(self, key: str, model: str, prompt_version: str, response: str) -> None:
+        self.memory.put(key, response)
+        now = datetime.utcnow()
+        try:
+            async with AsyncSessionLocal() as db:
+                # Просроченная запись с тем же ключом перезаписывается
+                await db.execute(delete(LLMResponse).where(LLMResponse.cache_key == key))
+                db.add(LLMResponse(
+                    cache_key=key,
+                    model=model,
+                    prompt_version=prompt_version,
+                    response=response,
+                    size=len(response.encode("utf-8")),
+                    hits=0,
+                    created_at=now,
+                    last_used_at=now
+                ))
+                await db.commit()
+            self.counters["stores"] += 1
+        except IntegrityError:
+            # Параллельный воркер уже сохранил ответ для этого ключа
+            pass
+        except Exception as e:
+            self.counters["errors"] += 1
+            logger.error(f"Ошибка записи кэша ответов LLM: {str(e)}")
+
+    async def prune(self) -> int:
+        """Удаляет просроченные ответы и самые давно использованные сверх LLM_CACHE_MAX_DB_BYTES."""
+        async with AsyncSessionLocal() as db:
+            removed = (await db.execute(
+                delete(LLMResponse).where(LLMResponse.created_at < datetime.utcnow() - self.ttl)
+            )).rowcount or 0
+            total = (await db.execute(select(func.coalesce(func.sum(LLMResponse.size), 0)))).scalar()
+            if total > self.max_db_bytes:
+                rows = (await db.execute(
+                    select(LLMResponse.id, LLMResponse.size).order_by(LLMResponse.last_used_at)
+                )).all()
+                evicted = []
+                for row_id, size in rows:
+                    if total <= self.max_db_bytes:
+                        break
+                    evicted.append(row_id)
+                    total -= size
+                for start in range(0, len(evicted), 1000):
+                    await db.execute(delete(LLMResponse).where(LLMResponse.id.in_(evicted[start:start + 1000])))
+                removed += len(evicted)
+            await db.commit()
+        return removed
+
+    def stats(self) -> Dict:
+        lookups = self.counters["memory_hits"] + self.counters["db_hits"] + self.counters["misses"]
+        hits = self.counters["memory_hits"] + self.counters["db_hits"]
+        return dict(
+            self.counters,
+            hit_rate=round(hits / lookups, 4) if lookups else 0.0,
+            memory_items=len(self.memory),
+            memory_bytes=self.memory.current_bytes
+        )
+
+    async def db_stats(self) -> Dict:
+        async with AsyncSessionLocal() as db:
+            count, size, hits = (await db.execute(select(
+                func.count(LLMResponse.id),
+                func.coalesce(func.sum(LLMResponse.size), 0),
+                func.coalesce(func.sum(LLMResponse.hits), 0)
+            ))).one()
+        return {"entries": count, "bytes": size, "hits": hits}
+
+
+llm_cache = LLMResponseCache(
+    max_memory_bytes=settings.LLM_CACHE_MEMORY_BYTES,
+    ttl=timedelta(days=settings.LLM_CACHE_TTL_DAYS),
+    max_db_bytes=settings.LLM_CACHE_MAX_DB_BYTES
+)
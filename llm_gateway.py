@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import math
+import time
+from typing import Callable, Dict, Optional
+
+from config import settings
+from key_pool import KeyPool, error_headers
+from llm_cache import cache_key, llm_cache
+
+logger = logging.getLogger(__name__)
+
+
+class LLMTimeoutError(Exception):
+    """LLM не ответила за отведённое время."""
+
+
+class _CallAbandoned(Exception):
+    """Запрос-владелец общего вызова отменён; ожидающие повторяют вызов сами."""
+
+
+class LLMBudgetExhaustedError(Exception):
+    """Лимиты всех ключей API исчерпаны дольше, чем можно ждать."""
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """429 (лимит запросов) и 413 (лимит токенов) лечатся сменой ключа и повтором."""
+    # Код ответа из исключения клиента Groq (APIStatusError.status_code или его response)
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code in (413, 429)
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: токенизатор модели Groq локально недоступен."""
+    return int(len(text) / settings.LLM_CHARS_PER_TOKEN) + 1
+
+
+class LLMGateway:
+    """
+    Асинхронный шлюз к LLM поверх ainvoke.
+
+    Ключ API для каждого запроса выбирает KeyPool (по остатку минутных
+    лимитов); ожидание свободного бюджета идёт до семафора и ограничено
+    LLM_BUDGET_WAIT_TIMEOUT, после чего вызов завершается LLMBudgetExhaustedError.
+    Сам запрос проходит через общий семафор (LLM_MAX_CONCURRENCY запросов в
+    полёте на процесс) и ограничен тайм-аутом LLM_TIMEOUT, поэтому медленный
+    ответ Groq не блокирует цикл событий. При 429/413 ключ откладывается, а
+    запрос повторяется на другом ключе не более LLM_MAX_RETRIES раз; при других
+    ошибках и тайм-ауте резерв токенов возвращается ключу.
+
+    Вызовы с prompt_version кэшируются (llm_cache), одинаковые запросы,
+    пришедшие одновременно, ждут один общий вызов LLM.
+    """
+
+    def __init__(self, pipeline, key_pool: KeyPool, max_concurrency: int, timeout: float, max_retries: int,
+                 budget_wait_timeout: float):
+        self.pipeline = pipeline
+        self.key_pool = key_pool
+        self.timeout = timeout
+        self.budget_wait_timeout = budget_wait_timeout
+        self.max_retries = max_retries
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def stats(self) -> Dict:
+        """Загрузка шлюза: запросов к LLM в полёте и ожидающих общего вызова."""
+        return {"in_flight": self.in_flight, "max_concurrency": self.max_concurrency, "pending": len(self._pending)}
+
+    async def _get_llm(self, key_index: int):
+        # Первое обращение импортирует langchain_groq и создаёт клиента — не в цикле событий
+        return await asyncio.to_thread(self.pipeline.llm_for_key, key_index)
+
+    async def _acquire_key(self, tokens: int, timeout: float) -> int:
+        """Ждёт ключ с достаточным остатком лимитов, но не дольше timeout."""
+        if not len(self.key_pool):
+            # Ждать нечего: без ключей бюджет не появится
+            raise LLMBudgetExhaustedError("Не задан ни один ключ API LLM (GROQ_API_KEY)")
+        deadline = time.monotonic() + timeout
+        while True:
+            key_index, wait = await asyncio.to_thread(self.key_pool.try_acquire, tokens)
+            if key_index is not None:
+                return key_index
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or wait == math.inf:
+                raise LLMBudgetExhaustedError(
+                    f"Исчерпаны лимиты всех ключей API LLM: свободного бюджета нет уже {timeout:.0f} с, "
+                    f"повторите запрос позже")
+            await asyncio.sleep(min(wait, remaining, 5.0))
+
+    async def ainvoke(self, prompt: str, timeout: Optional[float] = None, prompt_version: Optional[str] = None,
+                      validate: Optional[Callable[[str], bool]] = None, **kwargs) -> str:
+        """
+        Отправляет промпт и возвращает текст ответа. prompt_version — версия
+        шаблона промпта; без неё ответ не кэшируется. validate — проверка ответа
+        (например, что он разбирается): отвергнутый ответ возвращается, но не кэшируется.
+        """
+        if prompt_version is None or not settings.LLM_CACHE_ENABLED:
+            return await self._invoke(prompt, timeout, **kwargs)
+
+        key = cache_key(settings.MODEL_NAME, prompt_version, prompt, kwargs)
+        response = await llm_cache.get(key)
+        if response is not None:
+            return response
+        while key in self._pending:
+            try:
+                return await asyncio.shield(self._pending[key])
+            except _CallAbandoned:
+                # Владельца отменили: первый из ожидающих становится владельцем, остальные ждут его
+                continue
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            response = await self._invoke(prompt, timeout, **kwargs)
+            if validate is None or validate(response):
+                await llm_cache.put(key, settings.MODEL_NAME, prompt_version, response)
+            else:
+                logger.warning(f"Ответ LLM ({prompt_version}) не прошёл проверку и не сохранён в кэш")
+            future.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            # Ожидающие не отменены: передаём им не CancelledError, а сигнал повторить вызов
+            future.set_exception(_CallAbandoned())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # ошибку получают ожидающие; без них не выводить предупреждение
+            raise
+        finally:
+            self._pending.pop(key, None)
+
+    async def _invoke(self, prompt: str, timeout: Optional[float] = None, **kwargs) -> str:
+        timeout = timeout or self.timeout
+        tokens = estimate_tokens(prompt) + settings.LLM_COMPLETION_TOKENS_ESTIMATE
+        for attempt in range(self.max_retries + 1):
+            # Ждём бюджет ключа, не занимая место в семафоре
+            key_index = await self._acquire_key(tokens, self.budget_wait_timeout)
+            try:
+                llm = await self._get_llm(key_index)
+                async with self._semaphore:
+                    self.in_flight += 1
+                    try:
+                        response = await asyncio.wait_for(llm.ainvoke(prompt, **kwargs), timeout=timeout)
+                    finally:
+                        self.in_flight -= 1
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(self.key_pool.release, key_index, tokens)
+                raise LLMTimeoutError(f"LLM не ответила за {timeout} с")
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    await asyncio.to_thread(self.key_pool.release, key_index, tokens)
+                    raise
+                delay = await asyncio.to_thread(self.key_pool.penalize, key_index, error_headers(e))
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Ошибка лимита LLM на ключе {key_index} ({str(e)[:100]}), ключ отложен "
+                               f"на {delay:.1f} с, попытка {attempt + 1} из {self.max_retries}")
+                continue
+            await asyncio.to_thread(self.key_pool.record_success, key_index, tokens, used_tokens(response))
+            return response.content
+
+
+def used_tokens(response) -> Optional[int]:
+    """Фактический расход токенов из ответа langchain (usage_metadata или token_usage Groq)."""
+    usage = getattr(response, "usage_metadata", None) or {}
+    if usage.get("total_tokens") is not None:
+        return usage["total_tokens"]
+    return (getattr(response, "response_metadata", None) or {}).get("token_usage", {}).get("total_tokens")
+
+
+def create_gateway(pipeline) -> LLMGateway:
+    key_pool = KeyPool(
+        pipeline.API_KEYS,
+        path=settings.KEY_POOL_DB_PATH,
+        requests_per_minute=settings.LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute=settings.LLM_TOKENS_PER_MINUTE,
+        base_delay=settings.LLM_RETRY_DELAY,
+        max_delay=settings.LLM_RETRY_MAX_DELAY
+    )
+    return LLMGateway(
+        pipeline,
+        key_pool,
+        max_concurrency=settings.LLM_MAX_CONCURRENCY,
+        timeout=settings.LLM_TIMEOUT,
+        max_retries=settings.LLM_MAX_RETRIES,
+        budget_wait_timeout=settings.LLM_BUDGET_WAIT_TIMEOUT
+    )
@@ -1,5 +1,6 @@
 import os
 import time
+PROCESS_STARTED = time.perf_counter()  # отсчёт холодного старта для /ready
 import logging
 import re  # Добавляем импорт для работы с регулярными выражениями
 from dotenv import load_dotenv
@@ -10,17 +11,24 @@ from fastapi.middleware.cors import CORSMiddleware
 from collections import Counter
 from typing import Dict, List
 from config import settings
-from rag_pipeline import generate_analysis, explain_point, generate_detailed_explanation
+from rag_pipeline import rag_pipeline, generate_analysis, explain_point, generate_detailed_explanation
+from llm_gateway import LLMBudgetExhaustedError, LLMTimeoutError
+from llm_cache import llm_cache
 from database import get_db, UploadedFile, ComparisonSession, db_manager, AsyncSessionLocal, create_tables, engine
-from sqlalchemy import select
+from sqlalchemy import case, func, select, update
 import uuid
 import json
 from sqlalchemy.ext.asyncio import AsyncSession
-import hashlib
 from datetime import datetime
 from tasks import cleanup_task, calculate_storage_stats
 import asyncio
-from document_loader import DocumentLoader
+from text_cache import get_document
+from hybrid_index import tokenize
+from extraction_executor import extraction_executor
+from preprocessing import document_preprocessor
+from vector_store import get_library_index, search_similar
+from file_storage import (spool_upload, commit_blob, discard_spooled, blob_stored_name, release_blob,
+                          FileTooLargeError)
 
 load_dotenv()
 
@@ -29,7 +37,7 @@ logging.basicConfig(level=logging.INFO)
 
 app = FastAPI(title="Анализ документов")
 
-UPLOAD_DIR = "uploads"
+UPLOAD_DIR = settings.UPLOAD_DIR
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
 
@@ -123,75 +131,121 @@ async def processing_page():
     return FileResponse("static/processing.html")
 
 
+# Состояние прогрева моделей для /ready
+readiness = {"status": "starting", "cold_start_seconds": None, "timings": {}, "error": None}
+
+
+async def warm_up_models():
+    """Фоновый прогрев: загрузка эмбеддингов и клиента LLM с замером холодного старта."""
+    warm_up = asyncio.create_task(asyncio.to_thread(rag_pipeline.warm_up))
+    remaining = settings.COLD_START_BUDGET - (time.perf_counter() - PROCESS_STARTED)
+    try:
+        try:
+            timings = await asyncio.wait_for(asyncio.shield(warm_up), timeout=max(remaining, 0))
+        except asyncio.TimeoutError:
+            readiness["status"] = "slow"
+            logger.error(f"Прогрев моделей не уложился в бюджет холодного старта {settings.COLD_START_BUDGET} с")
+            timings = await warm_up
+        readiness["timings"] = timings
+        readiness["cold_start_seconds"] = round(time.perf_counter() - PROCESS_STARTED, 3)
+        readiness["status"] = "ready"
+        logger.info(f"Модели прогреты за {readiness['cold_start_seconds']} с от старта процесса: {timings}")
+    except Exception as e:
+        readiness["status"] = "failed"
+        readiness["error"] = str(e)
+        logger.error(f"Ошибка прогрева моделей: {str(e)}")
+
+
 @app.on_event("startup")
 async def startup_event():
     await create_tables(engine)
+    await asyncio.to_thread(rag_pipeline.sweep_stale_builds)
     asyncio.create_task(cleanup_task())
     asyncio.create_task(calculate_storage_stats())
+    if settings.WARMUP_ON_STARTUP:
+        asyncio.create_task(warm_up_models())
+    else:
+        readiness["status"] = "lazy"
+
+
+@app.get("/ready")
+async def ready():
+    """Проба готовности: 200 после прогрева моделей (или сразу при ленивой загрузке), иначе 503."""
+    is_ready = readiness["status"] in ("ready", "lazy")
+    return JSONResponse(
+        status_code=200 if is_ready else 503,
+        content={
+            "ready": is_ready,
+            "status": readiness["status"],
+            "models_loaded": rag_pipeline.is_loaded,
+            "cold_start_seconds": readiness["cold_start_seconds"],
+            "cold_start_budget": settings.COLD_START_BUDGET,
+            "timings": readiness["timings"],
+            "embedding_cache": rag_pipeline.embedding_cache.stats() if rag_pipeline.embedding_cache else None,
+            "error": readiness["error"]
+        }
+    )
 
 
-async def calculate_md5(file_path: str) -> str:
-    md5_hash = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            md5_hash.update(chunk)
-    return md5_hash.hexdigest()
-
-
-def validate_document_size(file: UploadFile, max_size: int = 10 * 1024 * 1024) -> bool:
-    file.file.seek(0, 2)
-    file_size = file.file.tell()
-    file.file.seek(0)
-    return file_size <= max_size
+@app.on_event("shutdown")
+async def shutdown_event():
+    extraction_executor.shutdown()
 
 
 @app.post("/upload")
 async def upload_file(file: UploadFile, db: AsyncSession = Depends(get_db)):
+    tmp_path = None
+    created_blob = None
     try:
-        if not validate_document_size(file):
-            raise HTTPException(status_code=413, detail="Размер файла превышает допустимый предел")
-
         file_ext = os.path.splitext(file.filename)[1]
-        stored_name = f"{uuid.uuid4()}{file_ext}"
-        file_path = os.path.join(UPLOAD_DIR, stored_name)
-
-        content = await file.read()
-        logger.info(f"Получен файл {file.filename}, размер: {len(content)} байт")
-
-        with open(file_path, "wb") as buffer:
-            buffer.write(content)
-
-        if not os.path.exists(file_path):
-            logger.error(f"Файл не был сохранён: {file_path}")
-            raise HTTPException(status_code=500, detail="Не удалось сохранить файл")
-        logger.info(f"Файл сохранён: {file_path}, размер: {os.path.getsize(file_path)} байт")
 
-        md5_hash = await calculate_md5(file_path)
-        logger.info(f"MD5 хэш файла {file_path}: {md5_hash}")
+        # Один проход по загрузке: запись во временный файл с подсчётом MD5 и размера
+        try:
+            tmp_path, file_size, md5_hash = await spool_upload(file, UPLOAD_DIR)
+        except FileTooLargeError as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        logger.info(f"Получен файл {file.filename}, размер: {file_size} байт, MD5: {md5_hash}")
 
         query = select(UploadedFile).where(UploadedFile.md5_hash == md5_hash, UploadedFile.is_deleted == False)
         result = await db.execute(query)
-        existing_file = result.scalar_one_or_none()
+        existing_file = result.scalars().first()
 
         if existing_file:
-            # Обновляем путь к файлу в базе, вместо удаления нового файла
-            existing_file.stored_name = stored_name
+            # Атомарный инкремент: параллельные загрузки и удаления не теряют ссылок.
+            # Дата загрузки обновляется, чтобы cleanup_old_files отсчитывал срок от последней загрузки
+            incremented = await db.execute(
+                update(UploadedFile)
+                .where(UploadedFile.id == existing_file.id, UploadedFile.is_deleted == False)
+                .values(ref_count=func.coalesce(UploadedFile.ref_count, 1) + 1, upload_date=datetime.utcnow())
+            )
             await db.commit()
-            await db.refresh(existing_file)
-            logger.info(f"Обновлён путь для дубликата: {file_path}, ID: {existing_file.id}")
-            return {
-                "status": "success",
-                "file_id": existing_file.id,
-                "filename": existing_file.original_name,
-                "message": "Файл уже существует, путь обновлён"
-            }
+            if incremented.rowcount:
+                await db.refresh(existing_file)
+                if os.path.exists(os.path.join(UPLOAD_DIR, existing_file.stored_name)):
+                    discard_spooled(tmp_path)
+                else:
+                    existing_file.stored_name, _ = commit_blob(tmp_path, UPLOAD_DIR, md5_hash, file_ext)
+                    await db.commit()
+                    logger.info(f"Восстановлен блоб для дубликата: {existing_file.stored_name}")
+                logger.info(f"Дубликат файла ID: {existing_file.id}, ссылок: {existing_file.ref_count}")
+                document_preprocessor.schedule(existing_file.id, existing_file.md5_hash)
+                return {
+                    "status": "success",
+                    "file_id": existing_file.id,
+                    "filename": existing_file.original_name,
+                    "message": "Файл уже существует"
+                }
+            # Запись удалили между выборкой и инкрементом — сохраняем как новый файл
+
+        stored_name, created_blob = commit_blob(tmp_path, UPLOAD_DIR, md5_hash, file_ext)
 
         db_file = UploadedFile(
             original_name=file.filename,
             stored_name=stored_name,
             file_type=file.content_type,
-            file_size=len(content),
+            file_size=file_size,
             md5_hash=md5_hash,
+            ref_count=1,
             upload_date=datetime.utcnow(),
             file_metadata={
                 "upload_ip": "user_ip",
@@ -204,20 +258,60 @@ async def upload_file(file: UploadFile, db: AsyncSession = Depends(get_db)):
         await db.refresh(db_file)
 
         logger.info(f"Файл добавлен в базу, ID: {db_file.id}")
+        document_preprocessor.schedule(db_file.id, db_file.md5_hash)
         return {
             "status": "success",
             "file_id": db_file.id,
             "filename": file.filename,
             "message": "Файл успешно загружен"
         }
+    except HTTPException:
+        raise
     except Exception as e:
         await db.rollback()
         logger.error(f"Ошибка при загрузке файла: {str(e)}")
-        if os.path.exists(file_path):
-            os.remove(file_path)  # Удаляем файл, если он был создан, но произошла ошибка
+        if tmp_path:
+            discard_spooled(tmp_path)
+        if created_blob:
+            # Блоб мог успеть сослаться параллельный запрос: удаляем только без ссылок в базе
+            await release_blob(db, UPLOAD_DIR, blob_stored_name(md5_hash, file_ext))
         raise HTTPException(status_code=400, detail=str(e))
 
 
+async def release_reference(db: AsyncSession, file_id: int):
+    """
+    Снимает одну ссылку с загруженного файла; со снятием последней файл помечается
+    удалённым, а блоб и производные артефакты освобождаются. Возвращает обновлённую
+    запись или None, если файл уже был удалён.
+    """
+    # Декремент и пометка удаления — одно атомарное обновление, чтобы параллельные запросы не теряли ссылок
+    ref_count = func.coalesce(UploadedFile.ref_count, 1)
+    decremented = await db.execute(
+        update(UploadedFile)
+        .where(UploadedFile.id == file_id, UploadedFile.is_deleted == False)
+        .values(
+            ref_count=case((ref_count > 1, ref_count - 1), else_=0),
+            is_deleted=ref_count <= 1,
+            delete_date=case((ref_count > 1, UploadedFile.delete_date), else_=datetime.utcnow())
+        )
+    )
+    await db.commit()
+    if not decremented.rowcount:
+        return None
+    file = await db.get(UploadedFile, file_id)
+    await db.refresh(file)
+    if not file.is_deleted:
+        return file
+
+    await release_blob(db, UPLOAD_DIR, file.stored_name)
+    # Удаление уже зафиксировано: ошибки освобождения артефактов только логируются
+    try:
+        await document_preprocessor.release(db, file.md5_hash)
+    except Exception as e:
+        logger.error(f"Ошибка удаления артефактов документа {file.md5_hash}: {str(e)}")
+    return file
+
+
 async def read_file_content(file_id: int, db: AsyncSession = Depends(get_db)) -> Dict:
     query = select(UploadedFile).where(UploadedFile.id == file_id)
     result = await db.execute(query)
@@ -233,11 +327,11 @@ async def read_file_content(file_id: int, db: AsyncSession = Depends(get_db)) ->
         logger.error(f"Файл не найден на диске: {file_path}")
         raise HTTPException(status_code=500, detail=f"Файл не найден на диске: {file_path}")
 
-    loader = DocumentLoader()
-    content = loader.load_document(file_path)
-    if not content:
+    document = await get_document(file, file_path, db)
+    if document is None:
         logger.error(f"Не удалось извлечь текст из файла: {file_path}")
         raise ValueError("Не удалось извлечь текст из файла")
+    content = document.text
 
     preview = content[:500] + "..." if len(content) > 500 else content
     logger.info(f"Прочитанный текст из файла {file.original_name} (ID: {file_id}):")
@@ -245,7 +339,8 @@ async def read_file_content(file_id: int, db: AsyncSession = Depends(get_db)) ->
 
     return {
         "raw_text": content,
-        "requirements": content.split("\n")
+        "md5_hash": file.md5_hash,
+        "document": document
     }
 
 
@@ -297,9 +392,14 @@ async def process_documents_task(session_id: str, tz_file_id: int, doc_file_id:
                                  db: AsyncSession):
     try:
         logger.info(f"Начало обработки сессии {session_id}")
+        # Артефакты обычно уже готовы после /upload; иначе присоединяемся к идущей предобработке
+        await asyncio.gather(
+            document_preprocessor.ensure(tz_file_id),
+            document_preprocessor.ensure(doc_file_id)
+        )
         tz_content = await read_file_content(tz_file_id, db)
         doc_content = await read_file_content(doc_file_id, db)
-        analysis_result = generate_analysis(tz_content, doc_content)
+        analysis_result = await generate_analysis(tz_content, doc_content)
 
         query = select(ComparisonSession).where(ComparisonSession.session_id == session_id)
         result = await db.execute(query)
@@ -326,6 +426,179 @@ async def process_documents_task(session_id: str, tz_file_id: int, doc_file_id:
             await db.commit()
 
 
+@app.post("/compare-batch")
+async def compare_batch(
+        background_tasks: BackgroundTasks,
+        tz_files: List[UploadFile] = File(...),
+        project_files: List[UploadFile] = File(...),
+        db: AsyncSession = Depends(get_db)
+):
+    """Пакетное сравнение: каждое ТЗ с каждой документацией (N×M сессий в одной группе)."""
+    # Каждая загрузка добавляет ссылку на файл; если пакет не создан, добавленные ссылки снимаются
+    uploaded_ids = []
+    try:
+        start_time = datetime.utcnow()
+        batch_id = str(uuid.uuid4())
+
+        for upload in [*tz_files, *project_files]:
+            uploaded_ids.append((await upload_file(upload, db))["file_id"])
+        tz_ids = uploaded_ids[:len(tz_files)]
+        doc_ids = uploaded_ids[len(tz_files):]
+        # Одинаковые файлы в наборе дают одну сессию
+        tz_ids = list(dict.fromkeys(tz_ids))
+        doc_ids = list(dict.fromkeys(doc_ids))
+
+        pairs = []
+        for tz_file_id in tz_ids:
+            for doc_file_id in doc_ids:
+                session_id = str(uuid.uuid4())
+                db.add(ComparisonSession(
+                    session_id=session_id,
+                    batch_id=batch_id,
+                    tz_file_id=tz_file_id,
+                    doc_file_id=doc_file_id,
+                    status="processing",
+                    created_at=start_time
+                ))
+                pairs.append((session_id, tz_file_id, doc_file_id))
+        await db.commit()
+
+        background_tasks.add_task(process_batch_task, batch_id, pairs, start_time)
+
+        return {
+            "status": "processing",
+            "batch_id": batch_id,
+            "sessions": [
+                {"session_id": session_id, "tz_file_id": tz_file_id, "doc_file_id": doc_file_id}
+                for session_id, tz_file_id, doc_file_id in pairs
+            ],
+            "message": f"Начат пакетный анализ: {len(pairs)} сравнений"
+        }
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Ошибка при пакетном сравнении: {str(e)}")
+        for file_id in uploaded_ids:
+            try:
+                await release_reference(db, file_id)
+            except Exception as release_error:
+                logger.error(f"Не удалось снять ссылку на файл {file_id}: {str(release_error)}")
+        if isinstance(e, HTTPException):
+            raise
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def process_batch_task(batch_id: str, pairs: List[tuple], start_time: datetime):
+    """
+    Обрабатывает пакет сравнений: пары идут параллельно, предобработка каждого
+    файла и извлечение требований каждого ТЗ выполняются один раз и
+    переиспользуются во всех парах (вместе с ошибкой, если она произошла).
+    """
+    logger.info(f"Начало обработки пакета {batch_id}: {len(pairs)} сравнений")
+    file_ids = {file_id for _, tz_file_id, doc_file_id in pairs for file_id in (tz_file_id, doc_file_id)}
+    preprocessing = await asyncio.gather(
+        *(document_preprocessor.ensure(file_id) for file_id in file_ids), return_exceptions=True
+    )
+    failed_files = {
+        file_id: result for file_id, result in zip(file_ids, preprocessing) if isinstance(result, Exception)
+    }
+
+    # Одна задача чтения на файл и одна задача извлечения требований на ТЗ: все пары
+    # получают общий результат или общую ошибку, без повторных вызовов LLM
+    contents: Dict[int, asyncio.Task] = {}
+    requirements_by_tz: Dict[int, asyncio.Task] = {}
+
+    async def load_content(file_id: int) -> Dict:
+        async with AsyncSessionLocal() as db:
+            return await read_file_content(file_id, db)
+
+    def content_task(file_id: int) -> asyncio.Task:
+        if file_id not in contents:
+            contents[file_id] = asyncio.create_task(load_content(file_id))
+        return contents[file_id]
+
+    async def extract_requirements(tz_file_id: int) -> List[Dict]:
+        return await rag_pipeline.extract_tz_requirements(await content_task(tz_file_id))
+
+    semaphore = asyncio.Semaphore(settings.BATCH_MAX_CONCURRENT_PAIRS)
+
+    async def process_pair(session_id: str, tz_file_id: int, doc_file_id: int) -> None:
+        async with semaphore, AsyncSessionLocal() as db:
+            try:
+                for file_id in (tz_file_id, doc_file_id):
+                    if file_id in failed_files:
+                        raise ValueError(f"Ошибка предобработки файла {file_id}: {failed_files[file_id]}")
+
+                if tz_file_id not in requirements_by_tz:
+                    requirements_by_tz[tz_file_id] = asyncio.create_task(extract_requirements(tz_file_id))
+                tz_content, doc_content, requirements = await asyncio.gather(
+                    content_task(tz_file_id), content_task(doc_file_id), requirements_by_tz[tz_file_id]
+                )
+                analysis_result = await generate_analysis(tz_content, doc_content, requirements)
+
+                session = (await db.execute(
+                    select(ComparisonSession).where(ComparisonSession.session_id == session_id)
+                )).scalar_one_or_none()
+                if session:
+                    end_time = datetime.utcnow()
+                    session.status = "completed"
+                    session.completed_at = end_time
+                    session.processing_time = int((end_time - start_time).total_seconds())
+                    session.result = analysis_result
+                    await db.commit()
+                logger.info(f"Сравнение {session_id} пакета {batch_id} завершено")
+            except Exception as e:
+                await db.rollback()
+                logger.error(f"Ошибка сравнения {session_id} пакета {batch_id}: {str(e)}")
+                session = (await db.execute(
+                    select(ComparisonSession).where(ComparisonSession.session_id == session_id)
+                )).scalar_one_or_none()
+                if session:
+                    session.status = "error"
+                    session.error_message = str(e)
+                    await db.commit()
+
+    # Пары идут параллельно (не больше BATCH_MAX_CONCURRENT_PAIRS одновременно)
+    await asyncio.gather(*(process_pair(*pair) for pair in pairs))
+    # Общие задачи, результат которых не понадобился ни одной паре, тоже дожидаемся
+    await asyncio.gather(*contents.values(), *requirements_by_tz.values(), return_exceptions=True)
+    logger.info(f"Пакет {batch_id} обработан")
+
+
+@app.get("/batch-status/{batch_id}")
+async def get_batch_status(batch_id: str, db: AsyncSession = Depends(get_db)):
+    try:
+        query = select(ComparisonSession).where(ComparisonSession.batch_id == batch_id)
+        sessions = (await db.execute(query)).scalars().all()
+
+        if not sessions:
+            raise HTTPException(status_code=404, detail="Пакет не найден")
+
+        counts = Counter(session.status for session in sessions)
+        return {
+            "batch_id": batch_id,
+            "status": "processing" if counts.get("processing") else "completed",
+            "total": len(sessions),
+            "completed": counts.get("completed", 0),
+            "errors": counts.get("error", 0),
+            "sessions": [
+                {
+                    "session_id": session.session_id,
+                    "tz_file_id": session.tz_file_id,
+                    "doc_file_id": session.doc_file_id,
+                    "status": session.status,
+                    "processing_time": session.processing_time,
+                    "error_message": session.error_message
+                }
+                for session in sessions
+            ]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при получении статуса пакета: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/status/{session_id}")
 async def get_status(session_id: str, db: AsyncSession = Depends(get_db)):
     try:
@@ -371,13 +644,16 @@ async def explain_requirement(request: Dict[str, str], db: AsyncSession = Depend
             raise HTTPException(status_code=400, detail="Требование не указано")
 
         # Запрашиваем пояснение через функцию explain_point из rag_pipeline
-        explanation = explain_point(requirement)
+        explanation = await explain_point(requirement)
         logger.info(f"Пояснение для требования '{requirement}': {explanation}")
 
         return JSONResponse(content={
             "requirement": requirement,
             "explanation": explanation
         })
+    except LLMBudgetExhaustedError as e:
+        logger.error(f"Лимиты LLM исчерпаны при получении пояснения: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка при получении пояснения: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка при обработке запроса: {str(e)}")
@@ -428,46 +704,54 @@ async def find_in_document(request: Dict[str, str], db: AsyncSession = Depends(g
         # Загружаем оригинальный текст документации
         doc_file = await db.get(UploadedFile, session.doc_file_id)
         doc_content = await read_file_content(doc_file.id, db)
-        full_text = doc_content['raw_text'].lower()
+        document = doc_content['document']
 
-        # 1. Строгий поиск точного совпадения
-        exact_matches = list(re.finditer(re.escape(requirement.lower()), full_text))
+        # 1. Строгий поиск точного совпадения (без учёта регистра, без копии текста в нижнем регистре)
+        exact_matches = list(re.finditer(re.escape(requirement), document.text, re.IGNORECASE))
 
         if exact_matches:
-            context = get_match_context(full_text, exact_matches[0])
-            cleaned_context = clean_text(context)
-            sentences = split_into_sentences(cleaned_context)
+            match = exact_matches[0]
+            # Предложения вокруг совпадения, обрезанные окном контекста: длинный абзац без точек не попадает целиком
+            context_start = max(0, match.start() - settings.FIND_CONTEXT_CHARS)
+            context_end = match.end() + settings.FIND_CONTEXT_CHARS
+            sentences = [
+                clean_text(document.text[max(start, context_start):min(end, context_end)].lower())
+                for start, end in document.sentence_spans_between(context_start, context_end)
+            ]
             return {
                 "status": "success",
                 "found": True,
                 "match_type": "exact",
                 "results": [{
-                    "content": sentences,  # Возвращаем список предложений
+                    "content": [s for s in sentences if s],  # Возвращаем список предложений
                     "positions": [[m.start(), m.end()] for m in exact_matches]
                 }]
             }
 
-        # 2. Поиск по ключевым словам из анализа
-        if "analysis" in card_analysis:
-            keywords = extract_keywords(card_analysis["analysis"])
-            found_sentences = []
-
-            for sentence in re.split(r'(?<=[.!?])\s+', full_text):
-                if any(keyword in sentence for keyword in keywords):
-                    cleaned_sentence = clean_text(sentence[:500])
-                    if cleaned_sentence:
+        # 2. Гибридный поиск (BM25 + векторы) по требованию и анализу из карточки
+        query = f"{requirement} {card_analysis.get('analysis', '')}"
+        query_terms = set(tokenize(query))
+        document_index = await asyncio.to_thread(rag_pipeline.get_document_index, doc_content['md5_hash'], document)
+        query_vector = await asyncio.to_thread(rag_pipeline.embeddings.embed_query, requirement)
+        found_sentences = []
+        for position, _ in document_index.search(query, query_vector, k=3):
+            chunk = document_index.chunks[position]
+            for sentence in document.sentences_between(chunk["start"], chunk["end"]):
+                if query_terms & set(tokenize(sentence)):
+                    cleaned_sentence = clean_text(sentence[:500].lower())
+                    if cleaned_sentence and cleaned_sentence not in found_sentences:
                         found_sentences.append(cleaned_sentence)
 
-            if found_sentences:
-                return {
-                    "status": "success",
-                    "found": True,
-                    "match_type": "keywords",
-                    "results": [{
-                        "content": found_sentences,  # Возвращаем список предложений
-                        "message": "Найдено по ключевым словам из анализа"
-                    }]
-                }
+        if found_sentences:
+            return {
+                "status": "success",
+                "found": True,
+                "match_type": "keywords",
+                "results": [{
+                    "content": found_sentences,  # Возвращаем список предложений
+                    "message": "Найдено гибридным поиском по требованию и анализу"
+                }]
+            }
 
         # 3. Если ничего не найдено
         return {
@@ -481,12 +765,6 @@ async def find_in_document(request: Dict[str, str], db: AsyncSession = Depends(g
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def get_match_context(text: str, match: re.Match, window: int = 100) -> str:
-    """Возвращает контекст вокруг совпадения"""
-    start = max(0, match.start() - window)
-    end = min(len(text), match.end() + window)
-    return text[start:end]
-
 def clean_text(text: str) -> str:
     """Очищает текст от лишних символов и форматирует ссылки"""
     # Удаляем или заменяем ссылки вида [...].21 4
@@ -495,18 +773,6 @@ def clean_text(text: str) -> str:
     text = re.sub(r'\s+', ' ', text).strip()
     return text
 
-def split_into_sentences(text: str) -> List[str]:
-    """Разбивает текст на предложения"""
-    sentences = re.split(r'(?<=[.!?])\s+', text)
-    return [s.strip() for s in sentences if s.strip()]
-
-
-def extract_keywords(text: str) -> List[str]:
-    """Извлекает ключевые слова из анализа"""
-    words = re.findall(r'\w{4,}', text.lower())  # Слова от 4 символов
-    freq = Counter(words)
-    return [word for word, count in freq.most_common(5)]  # Топ-5 частых слов
-
 
 @app.post("/detailed-explain")
 async def detailed_explain(
@@ -532,6 +798,12 @@ async def detailed_explain(
         tz_file = await db.get(UploadedFile, session.tz_file_id)
         doc_file = await db.get(UploadedFile, session.doc_file_id)
 
+        # Индексы чанков строятся один раз фоновой предобработкой; здесь только дожидаемся их
+        await asyncio.gather(
+            document_preprocessor.ensure(tz_file.id),
+            document_preprocessor.ensure(doc_file.id)
+        )
+
         # Читаем содержимое
         tz_content = await read_file_content(tz_file.id, db)
         doc_content = await read_file_content(doc_file.id, db)
@@ -543,7 +815,7 @@ async def detailed_explain(
             "Анализ не найден"
         )
 
-        explanation = generate_detailed_explanation(
+        explanation = await generate_detailed_explanation(
             requirement=requirement,
             tz_content=tz_content,
             doc_content=doc_content,
@@ -552,6 +824,12 @@ async def detailed_explain(
 
         return {"explanation": explanation}
 
+    except LLMTimeoutError as e:
+        logger.error(f"Тайм-аут детального пояснения: {str(e)}")
+        raise HTTPException(status_code=504, detail=str(e))
+    except LLMBudgetExhaustedError as e:
+        logger.error(f"Лимиты LLM исчерпаны при детальном пояснении: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка детального пояснения: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -725,6 +1003,95 @@ async def get_stats():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/llm-cache/stats")
+async def get_llm_cache_stats():
+    """
+    Счётчики попаданий кэша ответов LLM в этом процессе, объём таблицы
+    llm_responses и число запросов к LLM в полёте.
+    """
+    try:
+        return {
+            "process": llm_cache.stats(),
+            "database": await llm_cache.db_stats(),
+            "gateway": rag_pipeline.gateway.stats()
+        }
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики кэша LLM: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def library_files_by_hash(db: AsyncSession, md5_hashes) -> Dict[str, UploadedFile]:
+    """Неудалённые файлы библиотеки по хэшам содержимого."""
+    query = select(UploadedFile).where(UploadedFile.md5_hash.in_(set(md5_hashes)), UploadedFile.is_deleted == False)
+    return {file.md5_hash: file for file in (await db.execute(query)).scalars()}
+
+
+@app.post("/library/search")
+async def library_search(request: Dict, db: AsyncSession = Depends(get_db)):
+    """Поиск похожих фрагментов и требований по всем загруженным документам."""
+    try:
+        query_text = request.get("query")
+        if not query_text:
+            raise HTTPException(status_code=400, detail="Не указан текст запроса")
+        top_k = int(request.get("k") or settings.LIBRARY_SEARCH_TOP_K)
+
+        hits = await asyncio.to_thread(search_similar, query_text, top_k)
+        files = await library_files_by_hash(db, (hit["md5_hash"] for hit in hits))
+
+        results = []
+        documents: Dict[int, Dict] = {}
+        for hit in hits:
+            file = files.get(hit["md5_hash"])
+            if file is None:
+                continue
+            results.append({
+                "file_id": file.id,
+                "original_name": file.original_name,
+                "chunk_id": hit["chunk_id"],
+                "start": hit["start"],
+                "end": hit["end"],
+                "content": hit["content"][:500],
+                "distance": hit["distance"]
+            })
+            document = documents.setdefault(file.id, {
+                "file_id": file.id, "original_name": file.original_name, "matched_chunks": 0,
+                "best_distance": hit["distance"]
+            })
+            document["matched_chunks"] += 1
+        return {"results": results, "documents": list(documents.values())}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка поиска по библиотеке: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/library/similar/{file_id}")
+async def library_similar(file_id: int, k: int = 5, db: AsyncSession = Depends(get_db)):
+    """Документы библиотеки, похожие на загруженный файл."""
+    try:
+        file = await db.get(UploadedFile, file_id)
+        if not file or file.is_deleted:
+            raise HTTPException(status_code=404, detail="Файл не найден")
+        await document_preprocessor.ensure(file_id)
+
+        similar = await asyncio.to_thread(get_library_index().similar_documents, file.md5_hash, k)
+        files = await library_files_by_hash(db, (item["md5_hash"] for item in similar))
+        return {
+            "file_id": file_id,
+            "similar": [
+                {"file_id": files[item["md5_hash"]].id, "original_name": files[item["md5_hash"]].original_name,
+                 "score": item["score"], "matched_chunks": item["matched_chunks"]}
+                for item in similar if item["md5_hash"] in files
+            ]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка поиска похожих документов: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.delete("/files/{file_id}")
 async def delete_file(file_id: int, db: AsyncSession = Depends(get_db)):
     try:
@@ -735,9 +1102,14 @@ async def delete_file(file_id: int, db: AsyncSession = Depends(get_db)):
         if not file:
             raise HTTPException(status_code=404, detail="Файл не найден")
 
-        file.is_deleted = True
-        file.delete_date = datetime.utcnow()
-        await db.commit()
+        if file.is_deleted:
+            return {"status": "success", "message": "Файл уже удалён"}
+
+        file = await release_reference(db, file_id)
+        if file is None:
+            return {"status": "success", "message": "Файл уже удалён"}
+        if not file.is_deleted:
+            return {"status": "success", "message": f"Ссылка на файл снята, осталось ссылок: {file.ref_count}"}
 
         return {"status": "success", "message": "Файл помечен как удаленный"}
     except Exception as e:
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import os
+from typing import Dict
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from database import AsyncSessionLocal, UploadedFile
+from rag_pipeline import rag_pipeline
+from text_cache import get_document, release_text
+from vector_store import add_document, get_library_index
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentPreprocessor:
+    """
+    Фоновая предобработка загруженных документов:
+    извлечение -> нормализация -> чанки -> эмбеддинги -> сохранённый FAISS-индекс
+    -> сегмент библиотечного индекса.
+
+    Задачи идентифицируются хэшем содержимого: повторная загрузка того же файла
+    или /compare во время обработки присоединяются к уже идущей задаче.
+    """
+
+    def __init__(self):
+        self._jobs: Dict[str, asyncio.Task] = {}
+
+    def schedule(self, file_id: int, md5_hash: str) -> asyncio.Task:
+        """Ставит документ в обработку, если он ещё не обрабатывается."""
+        job = self._jobs.get(md5_hash)
+        if job is not None:
+            return job
+        job = asyncio.create_task(self._run(file_id, md5_hash))
+        self._jobs[md5_hash] = job
+        job.add_done_callback(lambda finished: self._finish(md5_hash, finished))
+        logger.info(f"Документ {md5_hash} (ID: {file_id}) поставлен в предобработку")
+        return job
+
+    def _finish(self, md5_hash: str, job: asyncio.Task) -> None:
+        if self._jobs.get(md5_hash) is job:
+            del self._jobs[md5_hash]
+        if not job.cancelled() and job.exception() is not None:
+            logger.error(f"Ошибка предобработки документа {md5_hash}: {job.exception()}")
+
+    async def ensure(self, file_id: int) -> None:
+        """Дожидается готовности артефактов документа: присоединяется к задаче или запускает её."""
+        async with AsyncSessionLocal() as db:
+            file = await db.get(UploadedFile, file_id)
+        if file is None:
+            raise ValueError(f"Файл {file_id} не найден")
+        await asyncio.shield(self.schedule(file_id, file.md5_hash))
+
+    async def _run(self, file_id: int, md5_hash: str) -> None:
+        async with AsyncSessionLocal() as db:
+            file = await db.get(UploadedFile, file_id)
+            if file is None:
+                raise ValueError(f"Файл {file_id} не найден")
+            file_path = os.path.join(settings.UPLOAD_DIR, file.stored_name)
+            document = await get_document(file, file_path, db)
+        if document is None:
+            raise ValueError(f"Не удалось извлечь текст из файла {file_id}")
+        document_index = await asyncio.to_thread(rag_pipeline.get_document_index, md5_hash, document)
+        try:
+            await asyncio.to_thread(add_document, md5_hash, document_index)
+        except Exception as e:
+            # Библиотечный индекс не должен блокировать сравнение документа
+            logger.error(f"Ошибка добавления документа {md5_hash} в библиотечный индекс: {str(e)}")
+        logger.info(f"Предобработка документа {md5_hash} завершена")
+
+    async def release(self, db: AsyncSession, md5_hash: str) -> bool:
+        """
+        Удаляет все производные артефакты содержимого (извлечённый текст и смещения,
+        FAISS-индексы документа, сегмент библиотеки), если на хэш не ссылается ни одна
+        неудалённая запись. Ошибка одного шага не мешает остальным.
+        """
+        query = select(func.count()).select_from(UploadedFile).where(
+            UploadedFile.md5_hash == md5_hash, UploadedFile.is_deleted == False
+        )
+        if (await db.execute(query)).scalar():
+            return False
+        job = self._jobs.get(md5_hash)
+        if job is not None:
+            # Иначе идущая предобработка допишет артефакты после удаления
+            await asyncio.wait([job])
+        steps = (
+            ("извлечённый текст", release_text(db, md5_hash)),
+            ("индексы документа", asyncio.to_thread(rag_pipeline.remove_document_indexes, md5_hash)),
+            ("сегмент библиотеки", asyncio.to_thread(lambda: get_library_index().remove_document(md5_hash)))
+        )
+        for name, step in steps:
+            try:
+                await step
+            except Exception as e:
+                logger.error(f"Ошибка удаления артефактов документа {md5_hash} ({name}): {str(e)}")
+        logger.info(f"Артефакты документа {md5_hash} удалены")
+        return True
+
+
+document_preprocessor = DocumentPreprocessor()
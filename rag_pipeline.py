@@ -1,15 +1,28 @@
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.prompts import PromptTemplate
-from langchain_groq import ChatGroq
-from typing import Dict, List, Tuple
+from __future__ import annotations
+
+from langchain_core.prompts import PromptTemplate
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+import asyncio
+import glob
 import os
 import logging
 from config import settings
-import shutil
+from document_model import StructuredDocument
+from embedding_cache import CachedEmbeddings, EmbeddingCache
+from embedding_backends import create_embeddings, embedding_model_id, model_slug
+from hybrid_index import HybridIndex, tokenize
+from llm_gateway import LLMBudgetExhaustedError, create_gateway, estimate_tokens
+from ann_index import apply_search_params, build_ann_index, load_ann_report, save_ann_report
+import numpy as np
 import re
+import shutil
 import time
+import threading
+from filelock import FileLock
+from collections import OrderedDict
+
+if TYPE_CHECKING:
+    from langchain_community.vectorstores import FAISS
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -84,68 +97,127 @@ detailed_explanation_prompt = PromptTemplate(
 ```"""
 )
 
+# Версии промптов входят в ключ кэша ответов LLM: менять при любом изменении шаблона
+PROMPT_VERSIONS = {
+    "tz_extraction": "tz_extraction-v1",
+    "comparison": "comparison-v1",
+    "detailed_explanation": "detailed_explanation-v1",
+    "explanation": "explanation-v1"
+}
+
+
+# Версия алгоритма чанкинга: входит в ключ сохранённых индексов, менять при изменении split_into_chunks
+CHUNKER_VERSION = "sentences-v2"
+
+
+def _process_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
 
 class RAGPipeline:
     # Список ключей и индекс текущего ключа
-    API_KEYS = settings.GROQ_API_KEY.split(",")  # Берем из settings, разделяем по запятой
-    current_key_index = 0
+    API_KEYS = [key.strip() for key in settings.GROQ_API_KEY.split(",") if key.strip()]  # ключи через запятую
 
     def __init__(self):
-        """Инициализация RAGPipeline."""
+        """
+        Инициализация RAGPipeline. Модели не загружаются: клиент LLM и эмбеддинги
+        создаются при первом обращении к llm/embeddings или в warm_up().
+        """
         self.model_name = settings.MODEL_NAME
         logger.info(f"Используемая модель: {self.model_name}")
         logger.info(f"Токен GROQ_API_KEY: {'установлен' if settings.GROQ_API_KEY else 'не установлен'}")
-        self.initialize_model()
-        self.initialize_embeddings()
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1200,
-            chunk_overlap=300,
-            separators=["\n\n", "\n", ". ", " ", ""]
-        )
+        self._llms: Dict[int, object] = {}  # клиенты LLM по номеру ключа
+        self._embeddings = None
+        self.embedding_cache: Optional[EmbeddingCache] = None
+        self._init_lock = threading.Lock()
+        self.gateway = create_gateway(self)
+        self.chunk_size = 1200
+        self.chunk_overlap = 300
+        self._indexes: "OrderedDict[str, HybridIndex]" = OrderedDict()
+        self._index_lock = threading.Lock()
         os.makedirs(settings.VECTOR_DB_PATH, exist_ok=True)
 
-    def initialize_model(self) -> None:
-        """Инициализация модели через Groq API."""
+    @property
+    def llm(self):
+        return self.llm_for_key(0)
+
+    def llm_for_key(self, key_index: int):
+        """Клиент LLM для ключа API с номером key_index (ключ выбирает KeyPool шлюза)."""
+        llm = self._llms.get(key_index)
+        if llm is None:
+            with self._init_lock:
+                llm = self._llms.get(key_index)
+                if llm is None:
+                    llm = self.initialize_model(key_index)
+        return llm
+
+    @property
+    def embeddings(self) -> CachedEmbeddings:
+        if self._embeddings is None:
+            with self._init_lock:
+                if self._embeddings is None:
+                    self.initialize_embeddings()
+        return self._embeddings
+
+    @property
+    def is_loaded(self) -> bool:
+        return bool(self._llms) and self._embeddings is not None
+
+    def _create_llm(self, key_index: int):
+        from langchain_groq import ChatGroq
+        return ChatGroq(
+            groq_api_key=self.API_KEYS[key_index],
+            model_name=self.model_name,
+            temperature=settings.TEMPERATURE,
+            max_tokens=settings.MAX_TOKENS
+        )
+
+    def initialize_model(self, key_index: int = 0):
+        """Инициализация модели через Groq API для ключа key_index."""
         try:
-            logger.info(f"Инициализация модели {self.model_name} через Groq с ключом {self.current_key_index}...")
-            self.llm = ChatGroq(
-                groq_api_key=self.API_KEYS[self.current_key_index].strip(),  # Первый ключ из списка, убираем пробелы
-                model_name=self.model_name,
-                temperature=settings.TEMPERATURE,
-                max_tokens=settings.MAX_TOKENS
-            )
+            logger.info(f"Инициализация модели {self.model_name} через Groq с ключом {key_index}...")
+            llm = self._llms[key_index] = self._create_llm(key_index)
             logger.info(f"Модель {self.model_name} успешно инициализирована!")
+            return llm
         except Exception as e:
             logger.error(f"Ошибка при инициализации модели: {str(e)}")
             raise
 
-    def switch_api_key(self) -> None:
-        """Переключение на следующий API ключ."""
-        try:
-            self.current_key_index = (self.current_key_index + 1) % len(self.API_KEYS)
-            logger.info(f"Переключение на ключ {self.current_key_index}")
-            self.llm = ChatGroq(
-                groq_api_key=self.API_KEYS[self.current_key_index].strip(),  # Убираем лишние пробелы
-                model_name=self.model_name,
-                temperature=settings.TEMPERATURE,
-                max_tokens=settings.MAX_TOKENS
-            )
-            logger.info(f"Успешно переключено на ключ {self.current_key_index}")
-        except Exception as e:
-            logger.error(f"Ошибка при переключении ключа: {str(e)}")
-            raise
-
     def initialize_embeddings(self) -> None:
-        """Инициализация эмбеддингов."""
+        """Инициализация эмбеддингов из локального каталога модели."""
         try:
-            self.embeddings = HuggingFaceEmbeddings(
-                model_name="sentence-transformers/all-MiniLM-L6-v2"
+            base_embeddings, embedding_model_name = create_embeddings(settings.EMBEDDING_MODEL)
+            self.embedding_cache = EmbeddingCache(
+                os.path.join(settings.EMBEDDING_CACHE_DIR, model_slug(embedding_model_name)),
+                max_bytes=settings.EMBEDDING_CACHE_MAX_BYTES,
+                dtype=settings.EMBEDDING_CACHE_DTYPE
             )
+            self.embedding_model_name = embedding_model_name
+            self._embeddings = CachedEmbeddings(base_embeddings, self.embedding_cache)
             logger.info("Эмбеддинги успешно инициализированы")
         except Exception as e:
             logger.error(f"Ошибка при инициализации эмбеддингов: {str(e)}")
             raise
 
+    def warm_up(self) -> Dict[str, float]:
+        """Загружает модели и прогоняет пробный запрос; возвращает время этапов в секундах."""
+        timings = {}
+        started = time.perf_counter()
+        self.embeddings.embed_query("прогрев модели эмбеддингов")
+        timings["embeddings"] = round(time.perf_counter() - started, 3)
+        started = time.perf_counter()
+        self.llm
+        timings["llm"] = round(time.perf_counter() - started, 3)
+        return timings
+
     def clean_text(self, text: str) -> str:
         """Очистка текста от лишних символов."""
         text = re.sub(r'\s+', ' ', text)  # Удаляем лишние пробелы
@@ -153,212 +225,480 @@ class RAGPipeline:
         text = text.strip()
         return text
 
-    def split_into_chunks(self, text: str, source: str) -> List[Dict]:
-        """Разбивает текст на чанки с метаданными."""
-        cleaned_text = self.clean_text(text)
-        chunks = self.text_splitter.split_text(cleaned_text)
-        return [{"content": chunk, "metadata": {"source": source, "chunk_id": i+1}} for i, chunk in enumerate(chunks)]
-
-    def process_documents(self, tz_content: Dict, doc_content: Dict) -> Tuple[FAISS, FAISS]:
-        """Обработка документов и создание векторного хранилища с FAISS."""
+    def split_into_chunks(self, document: StructuredDocument, source: str) -> List[Dict]:
+        """Разбивает документ на чанки по таблице предложений, сохраняя смещения в метаданных."""
+        chunks = []
+        for start, end in document.chunks(self.chunk_size, self.chunk_overlap):
+            content = self.clean_text(document.text[start:end])
+            if content:
+                chunks.append({
+                    "content": content,
+                    "metadata": {"source": source, "chunk_id": len(chunks) + 1, "start": start, "end": end}
+                })
+        return chunks
+
+    @property
+    def embedding_slug(self) -> str:
+        """Имя модели эмбеддингов для путей кэшей и индексов; сама модель не загружается."""
+        if self._embeddings is not None:
+            return model_slug(self.embedding_model_name)
+        return model_slug(embedding_model_id(settings.EMBEDDING_MODEL))
+
+    def index_path(self, md5_hash: str) -> str:
+        """Каталог индекса: хэш документа + модель эмбеддингов + версия чанкера (+ кодек векторов)."""
+        chunker_slug = f"{CHUNKER_VERSION}-{self.chunk_size}-{self.chunk_overlap}"
+        if settings.VECTOR_CODEC != "flat":
+            chunker_slug = f"{chunker_slug}-{settings.VECTOR_CODEC}"
+        return os.path.join(settings.VECTOR_DB_PATH, "documents", self.embedding_slug, chunker_slug, md5_hash)
+
+    def remove_document_indexes(self, md5_hash: str) -> int:
+        """
+        Удаляет FAISS-индексы документа для всех моделей и версий чанкера вместе с
+        блокировками и недостроенными каталогами; возвращает число удалённых путей.
+        """
+        with self._index_lock:
+            for index_path in [path for path in self._indexes if os.path.basename(path) == md5_hash]:
+                del self._indexes[index_path]
+        removed = 0
+        for path in glob.glob(os.path.join(settings.VECTOR_DB_PATH, "documents", "*", "*", f"{md5_hash}*")):
+            name = os.path.basename(path)
+            if name not in (md5_hash, f"{md5_hash}.lock") and not name.startswith(f"{md5_hash}.tmp-"):
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+            removed += 1
+        return removed
+
+    @staticmethod
+    def sweep_stale_builds() -> int:
+        """Удаляет каталоги «<индекс>.tmp-<pid>-<поток>», оставшиеся от завершившихся процессов."""
+        removed = 0
+        for path in glob.glob(os.path.join(settings.VECTOR_DB_PATH, "documents", "*", "*", "*.tmp-*")):
+            match = re.search(r'\.tmp-(\d+)-\d+$', path)
+            if not match or _process_alive(int(match.group(1))):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+        if removed:
+            logger.info(f"Удалено незавершённых сборок индексов: {removed}")
+        return removed
+
+    def _build_index(self, md5_hash: str, document: StructuredDocument, index_path: str) -> FAISS:
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+        from langchain_community.vectorstores import FAISS
+        from langchain_core.documents import Document
+        chunks = self.split_into_chunks(document, md5_hash)
+        logger.info(f"Создано чанков для документа {md5_hash}: {len(chunks)}")
+        vectors = np.asarray(self.embeddings.embed_documents([chunk["content"] for chunk in chunks]), dtype=np.float32)
+        # Тип индекса (Flat/HNSW/IVF) и параметры поиска выбираются по числу чанков, хранение — по VECTOR_CODEC
+        index, ann_report = build_ann_index(vectors)
+        docstore_ids = [f"{md5_hash}-{chunk['metadata']['chunk_id']}" for chunk in chunks]
+        vectorstore = FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore({
+                docstore_id: Document(page_content=chunk["content"], metadata=chunk["metadata"])
+                for docstore_id, chunk in zip(docstore_ids, chunks)
+            }),
+            index_to_docstore_id=dict(enumerate(docstore_ids))
+        )
+        # Пишем во временный каталог и атомарно публикуем переименованием
+        tmp_path = f"{index_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        vectorstore.save_local(tmp_path)
+        save_ann_report(tmp_path, ann_report)
+        try:
+            os.replace(tmp_path, index_path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.exists(index_path):
+                raise
+        logger.info(f"Создан и сохранён FAISS индекс документа {md5_hash}: {index_path}")
+        return vectorstore
+
+    def get_document_index(self, md5_hash: str, document: StructuredDocument) -> HybridIndex:
+        """
+        Возвращает гибридный индекс документа (BM25 + FAISS): из памяти процесса,
+        с диска или строит новый. Лексическая часть строится при загрузке FAISS-индекса.
+
+        Сборка для одного ключа выполняется под файловой блокировкой: параллельные
+        сессии (в том числе из других процессов) дожидаются её и загружают готовый индекс.
+        """
+        index_path = self.index_path(md5_hash)
+        vectorstore = None
+        with self._index_lock:
+            hybrid_index = self._indexes.get(index_path)
+            if hybrid_index is not None:
+                self._indexes.move_to_end(index_path)
+                return hybrid_index
+
+        if not os.path.exists(index_path):
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            with FileLock(f"{index_path}.lock", timeout=settings.INDEX_BUILD_LOCK_TIMEOUT):
+                if not os.path.exists(index_path):
+                    vectorstore = self._build_index(md5_hash, document, index_path)
+        if vectorstore is None:
+            from langchain_community.vectorstores import FAISS
+            vectorstore = FAISS.load_local(index_path, self.embeddings, allow_dangerous_deserialization=True)
+            apply_search_params(vectorstore.index, load_ann_report(index_path))
+            logger.info(f"Загружен сохранённый FAISS индекс документа {md5_hash}")
+
+        hybrid_index = HybridIndex.from_vectorstore(vectorstore)
+        with self._index_lock:
+            self._indexes[index_path] = hybrid_index
+            while len(self._indexes) > settings.INDEX_CACHE_SIZE:
+                self._indexes.popitem(last=False)
+        return hybrid_index
+
+    def process_documents(self, tz_content: Dict, doc_content: Dict) -> Tuple[HybridIndex, HybridIndex]:
+        """Обработка документов: индексы ТЗ и документации (готовые переиспользуются)."""
         try:
             logger.info("Начало обработки документов...")
             if not isinstance(tz_content, dict) or not isinstance(doc_content, dict):
                 raise ValueError("Неправильный формат данных: ожидается словарь")
-            
-            tz_chunks = self.split_into_chunks(tz_content['raw_text'], "tz")
-            doc_chunks = self.split_into_chunks(doc_content['raw_text'], "doc")
-            
-            logger.info(f"Создано чанков: ТЗ - {len(tz_chunks)}, Документация - {len(doc_chunks)}")
-            
-            tz_faiss_path = os.path.join(settings.VECTOR_DB_PATH, "tz_faiss")
-            doc_faiss_path = os.path.join(settings.VECTOR_DB_PATH, "doc_faiss")
-
-            if os.path.exists(tz_faiss_path):
-                shutil.rmtree(tz_faiss_path)
-                logger.info("Удалён старый индекс FAISS для ТЗ")
-            if os.path.exists(doc_faiss_path):
-                shutil.rmtree(doc_faiss_path)
-                logger.info("Удалён старый индекс FAISS для документации")
-
-            tz_vectorstore = FAISS.from_texts(
-                texts=[chunk["content"] for chunk in tz_chunks],
-                embedding=self.embeddings,
-                metadatas=[chunk["metadata"] for chunk in tz_chunks]
-            )
-            tz_vectorstore.save_local(tz_faiss_path)
-            logger.info("Создан и сохранён FAISS индекс для ТЗ")
 
-            doc_vectorstore = FAISS.from_texts(
-                texts=[chunk["content"] for chunk in doc_chunks],
-                embedding=self.embeddings,
-                metadatas=[chunk["metadata"] for chunk in doc_chunks]
-            )
-            doc_vectorstore.save_local(doc_faiss_path)
-            logger.info("Создан и сохранён FAISS индекс для документации")
-            
-            return tz_vectorstore, doc_vectorstore
+            tz_index = self.get_document_index(tz_content['md5_hash'], tz_content['document'])
+            doc_index = self.get_document_index(doc_content['md5_hash'], doc_content['document'])
+            return tz_index, doc_index
         except Exception as e:
             logger.error(f"Ошибка при обработке документов: {str(e)}")
             raise
 
-    def extract_tz_requirements(self, tz_content: Dict) -> str:
-        """Извлекает требования из ТЗ с промптом."""
+    @staticmethod
+    def locate_requirements(document: StructuredDocument, requirements: List[str], start: int,
+                            end: int) -> List[Tuple[int, int]]:
+        """Для каждого требования — смещения предложения фрагмента [start, end) с наибольшим числом общих терминов."""
+        sentences = [(max(sentence_start, start), min(sentence_end, end))
+                     for sentence_start, sentence_end in document.sentence_spans_between(start, end)]
+        sentence_terms = [set(tokenize(document.text[sentence_start:sentence_end]))
+                          for sentence_start, sentence_end in sentences]
+        spans = []
+        for requirement in requirements:
+            terms = set(tokenize(requirement))
+            overlaps = [len(terms & candidate) for candidate in sentence_terms]
+            best = max(range(len(overlaps)), key=overlaps.__getitem__, default=None)
+            spans.append(sentences[best] if best is not None and overlaps[best] else (start, end))
+        return spans
+
+    @staticmethod
+    def suppress_duplicates(items: List[Dict], threshold: float = None) -> List[Dict]:
+        """
+        Убирает почти одинаковые требования (из перекрывающихся или повторяющих
+        друг друга разделов ТЗ): сходство Жаккара по стеммированным терминам не
+        ниже threshold; числа (вместе с разделителями, «1.2», «10-20») входят в
+        термины целиком, чтобы «не менее 10» и «не менее 100» не склеивались. Остаётся первое по тексту ТЗ.
+        """
+        threshold = settings.TZ_DUPLICATE_SIMILARITY if threshold is None else threshold
+        kept: List[Dict] = []
+        kept_terms: List[frozenset] = []
+        by_term: Dict[str, List[int]] = {}
+        for item in sorted(items, key=lambda item: item["start"]):
+            text = item["requirement"]
+            terms = frozenset(term for term in tokenize(text) if not term.isdigit()) \
+                | frozenset(re.findall(r'\d+(?:[.,-]\d+)*', text))
+            candidates = {index for term in terms for index in by_term.get(term, ())}
+            if not terms or any(len(terms & kept_terms[index]) / len(terms | kept_terms[index]) >= threshold
+                                for index in candidates):
+                continue
+            for term in terms:
+                by_term.setdefault(term, []).append(len(kept))
+            kept.append(item)
+            kept_terms.append(terms)
+        return kept
+
+    @staticmethod
+    def parse_requirements(response: str) -> List[str]:
+        """Требования из ответа LLM: строки «- ...» длиннее 10 символов."""
+        requirements = []
+        for line in response.split("\n"):
+            line = line.strip()
+            if line.startswith("- ") and len(line[2:].strip()) > 10:
+                requirements.append(line[2:].strip())
+        return requirements
+
+    async def extract_section_requirements(self, document: StructuredDocument, start: int, end: int,
+                                           number: int) -> List[Dict]:
+        """Требования одного раздела ТЗ со смещениями исходных предложений."""
         try:
-            logger.info("Извлечение требований из ТЗ...")
-            tz_text = tz_content["raw_text"][:10000]
-            
-            requirements = self.llm.invoke(tz_extraction_prompt.format(text=tz_text)).content
-            logger.info(f"Извлечённые требования с помощью LLM:\n{requirements}")
-            
-            cleaned_requirements = []
-            for line in requirements.split("\n"):
-                line = line.strip()
-                if line.startswith("- ") and len(line[2:].strip()) > 10:
-                    cleaned_requirements.append(line[2:].strip())
-            
-            return "\n".join(f"- {req}" for req in cleaned_requirements)
+            response = await self.gateway.ainvoke(tz_extraction_prompt.format(text=document.text[start:end]),
+                                                  prompt_version=PROMPT_VERSIONS["tz_extraction"],
+                                                  validate=lambda text: bool(self.parse_requirements(text)))
+            logger.info(f"Извлечённые требования раздела {number} с помощью LLM:\n{response}")
+            requirements = self.parse_requirements(response)
+            return [
+                {"requirement": requirement, "start": span[0], "end": span[1]}
+                for requirement, span in zip(requirements, self.locate_requirements(document, requirements, start, end))
+            ]
+        except LLMBudgetExhaustedError:
+            # Без LLM требования извлекаются заметно хуже — сообщаем пользователю, а не подменяем результат
+            raise
         except Exception as e:
-            if "429" in str(e) or "413" in str(e):  # Обработка 429 и 413
-                logger.warning(f"Ошибка {str(e).split()[2] if len(str(e).split()) > 2 else 'неизвестно'}, переключение ключа...")
-                self.switch_api_key()
-                time.sleep(2)  # Задержка для соблюдения лимитов
-                return self.extract_tz_requirements(tz_content)  # Повторная попытка
-            logger.error(f"Ошибка при извлечении требований из ТЗ: {str(e)}")
-            tz_chunks = self.split_into_chunks(tz_text, "tz")
-            fallback_result = "\n".join(f"- {chunk['content']}" for chunk in tz_chunks if "должен" in chunk['content'].lower())
-            logger.info(f"Использован fallback в extract_tz_requirements:\n{fallback_result}")
-            return fallback_result
-
-    def analyze_documents(self, tz_vectorstore: FAISS, doc_vectorstore: FAISS, tz_content: Dict) -> List[Dict]:
+            logger.error(f"Ошибка при извлечении требований из раздела {number}: {str(e)}")
+            items = []
+            for sentence_start, sentence_end in document.sentence_spans_between(start, end):
+                sentence = self.clean_text(document.text[sentence_start:sentence_end])
+                if "долж" in sentence.lower():  # должен, должна, должны
+                    items.append({"requirement": sentence, "start": sentence_start, "end": sentence_end})
+            logger.info(f"Использован fallback для раздела {number}: {len(items)} требований")
+            return items
+
+    async def extract_tz_requirements(self, tz_content: Dict) -> List[Dict]:
+        """
+        Извлекает требования из всего ТЗ.
+
+        Текст делится на фрагменты по границам разделов (до TZ_EXTRACTION_CHUNK_CHARS
+        символов), фрагменты обрабатываются параллельно через шлюз LLM, почти
+        одинаковые требования схлопываются. Каждое требование —
+        {"requirement", "start", "end"} со смещениями исходного предложения в ТЗ.
+        """
+        logger.info("Извлечение требований из ТЗ...")
+        document = tz_content["document"]
+        sections = document.sections(settings.TZ_EXTRACTION_CHUNK_CHARS)
+        logger.info(f"ТЗ разбито на {len(sections)} фрагментов для извлечения требований")
+        section_items = await asyncio.gather(*(
+            self.extract_section_requirements(document, start, end, number)
+            for number, (start, end) in enumerate(sections, 1)
+        ))
+        items = self.suppress_duplicates([item for items in section_items for item in items])
+        logger.info(f"Извлечено требований: {len(items)} "
+                    f"(до удаления повторов: {sum(len(items) for items in section_items)})")
+        return items
+
+    def retrieve_evidence(self, requirement_list: List[str], doc_index: HybridIndex,
+                          k: int = None) -> List[List[Dict]]:
+        """
+        Подбирает для каждого требования top-k чанков документации.
+
+        Все требования кодируются одним пакетом; векторная часть ищется одним
+        матричным запросом к FAISS и объединяется с BM25. Возвращает для каждого
+        требования список чанков {"chunk_id", "content", "start", "end", "score"}
+        по убыванию релевантности.
+        """
+        k = k or settings.EVIDENCE_TOP_K
+        if not requirement_list or not len(doc_index):
+            return [[] for _ in requirement_list]
+        query_vectors = self.embeddings.embed_queries(requirement_list)
+        return [
+            [dict(doc_index.chunks[position], position=position, score=score) for position, score in hits]
+            for hits in doc_index.search_many(requirement_list, query_vectors, k)
+        ]
+
+    @staticmethod
+    def build_evidence_context(evidence: List[List[Dict]], max_chars: int = None) -> str:
+        """
+        Собирает контекст документации без повторов: сначала лучший чанк каждого
+        требования, затем вторые и т.д., пока не исчерпан лимит; в промпт чанки
+        идут в порядке следования в документе.
+        """
+        max_chars = max_chars or settings.EVIDENCE_MAX_CHARS
+        selected: Dict[int, Dict] = {}
+        total = 0
+        for rank in range(max((len(hits) for hits in evidence), default=0)):
+            for hits in evidence:
+                if rank >= len(hits) or hits[rank]["chunk_id"] in selected:
+                    continue
+                chunk = hits[rank]
+                if total + len(chunk["content"]) > max_chars:
+                    continue
+                selected[chunk["chunk_id"]] = chunk
+                total += len(chunk["content"])
+        return "\n".join(chunk["content"] for chunk in sorted(selected.values(), key=lambda chunk: chunk["start"]))
+
+    @staticmethod
+    def batch_requirements(requirement_list: List[str], max_tokens: int = None,
+                           max_items: int = None) -> List[Tuple[int, int]]:
+        """
+        Делит список требований на подряд идущие пакеты, ограниченные оценкой
+        числа токенов и количеством требований. Возвращает границы [start, end).
+        Требование длиннее лимита образует отдельный пакет.
+        """
+        max_tokens = max_tokens or settings.COMPARISON_BATCH_TOKENS
+        max_items = max_items or settings.COMPARISON_BATCH_MAX_REQUIREMENTS
+        batches = []
+        start, tokens = 0, 0
+        for position, requirement in enumerate(requirement_list):
+            requirement_tokens = estimate_tokens(requirement)
+            if position > start and (tokens + requirement_tokens > max_tokens or position - start >= max_items):
+                batches.append((start, position))
+                start, tokens = position, 0
+            tokens += requirement_tokens
+        if start < len(requirement_list):
+            batches.append((start, len(requirement_list)))
+        return batches
+
+    @staticmethod
+    def parse_comparison(comparison_result: str) -> List[Dict]:
+        """Разбирает ответ LLM в формате «- Требование / - Соответствует / - Причина»."""
+        analysis_results = []
+        current_requirement = {}
+        for line in comparison_result.split("\n"):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("- Требование:"):
+                if current_requirement:
+                    analysis_results.append(current_requirement)
+                req_text = line.replace("- Требование:", "").strip()
+                if req_text.startswith("[") and req_text.endswith("]"):
+                    req_text = req_text[1:-1]
+                current_requirement = {"requirement": req_text}
+            elif line.startswith("- Соответствует:"):
+                status_text = line.replace("- Соответствует:", "").strip()
+                if status_text.startswith("[") and status_text.endswith("]"):
+                    status_text = status_text[1:-1]
+                # Изменяем статус на нужный текст
+                status = "соответствует ТЗ" if status_text.lower() == "да" else "не соответствует ТЗ"
+                criticality = "нет" if status == "соответствует ТЗ" else "высокая"
+                current_requirement["status"] = {"status": status, "criticality": criticality}
+            elif line.startswith("- Причина:"):
+                reason = line.replace("- Причина:", "").strip()
+                if reason.startswith("[") and reason.endswith("]"):
+                    reason = reason[1:-1]
+                current_requirement["analysis"] = reason
+
+        if current_requirement:
+            analysis_results.append(current_requirement)
+        return analysis_results
+
+    @staticmethod
+    def fallback_analysis(req_blocks: List[str], evidence: List[List[Dict]], doc_index: HybridIndex) -> List[Dict]:
+        """Оценка без LLM: требование считается найденным, если чанк покрывает его термины."""
+        fallback_result = []
+        for req, hits in zip(req_blocks, evidence):
+            matches = any(doc_index.term_coverage(req, hit["position"]) >= settings.HYBRID_MATCH_COVERAGE
+                          for hit in hits)
+            # Используем нужный текст и в fallback
+            status = "соответствует ТЗ" if matches else "не соответствует ТЗ"
+            criticality = "нет" if matches else "высокая"
+            fallback_result.append({
+                "requirement": req,
+                "status": {"status": status, "criticality": criticality},
+                "analysis": "Найдено в документации" if matches else "Не найдено в документации"
+            })
+        return fallback_result
+
+    @staticmethod
+    def requirement_key(requirement: str) -> str:
+        return re.sub(r'\s+', ' ', requirement).strip().lower().rstrip(".;")
+
+    @staticmethod
+    def merge_analysis(batch_results: List[List[Dict]]) -> List[Dict]:
+        """Склеивает результаты пакетов в исходном порядке, убирая повторы требований."""
+        merged = []
+        seen = set()
+        for results in batch_results:
+            for item in results:
+                key = RAGPipeline.requirement_key(item.get("requirement", ""))
+                if not key or key in seen:
+                    continue
+                seen.add(key)
+                merged.append(item)
+        return merged
+
+    async def compare_batch(self, batch: List[str], evidence: List[List[Dict]], doc_index: HybridIndex,
+                            number: int) -> List[Dict]:
+        """Сравнивает один пакет требований с найденным для него контекстом документации."""
+        doc_text = self.build_evidence_context(evidence)
         try:
-            logger.info("Начало анализа документов...")
-            requirements = self.extract_tz_requirements(tz_content)
-            doc_docs = doc_vectorstore.similarity_search("", k=10)
-            doc_text = "\n".join(doc.page_content for doc in doc_docs)[:10000]
-            
-            comparison_result = self.llm.invoke(comparison_prompt.format(
-                requirements=requirements,
+            comparison_result = await self.gateway.ainvoke(comparison_prompt.format(
+                requirements="\n".join(f"- {req}" for req in batch),
                 doc_content=doc_text
-            )).content
-            logger.info(f"Результат сравнения от Grok:\n{comparison_result}")
-
-            # Обработка ответа от Grok
-            analysis_results = []
-            lines = comparison_result.split("\n")
-            current_requirement = {}
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
-                if line.startswith("- Требование:"):
-                    if current_requirement:
-                        analysis_results.append(current_requirement)
-                    req_text = line.replace("- Требование:", "").strip()
-                    if req_text.startswith("[") and req_text.endswith("]"):
-                        req_text = req_text[1:-1]
-                    current_requirement = {"requirement": req_text}
-                elif line.startswith("- Соответствует:"):
-                    status_text = line.replace("- Соответствует:", "").strip()
-                    if status_text.startswith("[") and status_text.endswith("]"):
-                        status_text = status_text[1:-1]
-                    # Изменяем статус на нужный текст
-                    status = "соответствует ТЗ" if status_text.lower() == "да" else "не соответствует ТЗ"
-                    criticality = "нет" if status == "соответствует ТЗ" else "высокая"
-                    current_requirement["status"] = {"status": status, "criticality": criticality}
-                elif line.startswith("- Причина:"):
-                    reason = line.replace("- Причина:", "").strip()
-                    if reason.startswith("[") and reason.endswith("]"):
-                        reason = reason[1:-1]
-                    current_requirement["analysis"] = reason
-            
-            if current_requirement:
-                analysis_results.append(current_requirement)
-
-            logger.info(f"Итоговый анализ:\n{analysis_results}")
-            logger.info("Анализ документов завершен успешно")
-            return analysis_results
+            ), prompt_version=PROMPT_VERSIONS["comparison"], validate=lambda text: bool(self.parse_comparison(text)))
+            logger.info(f"Результат сравнения пакета {number} от Grok:\n{comparison_result}")
+            results = self.parse_comparison(comparison_result)
+            if results:
+                return results
+            logger.warning(f"Пустой разбор ответа для пакета {number}")
+        except LLMBudgetExhaustedError:
+            raise
         except Exception as e:
-            if "429" in str(e) or "413" in str(e):  # Обработка 429 и 413
-                logger.warning(f"Ошибка {str(e).split()[2] if len(str(e).split()) > 2 else 'неизвестно'}, переключение ключа...")
-                self.switch_api_key()
-                time.sleep(2)  # Задержка для соблюдения лимитов
-                return self.analyze_documents(tz_vectorstore, doc_vectorstore, tz_content)  # Повторная попытка
-            logger.error(f"Ошибка при анализе документов: {str(e)}")
-            req_blocks = [r.strip()[2:] for r in requirements.split("\n") if r.strip().startswith("- ")]
-            doc_blocks = [doc.page_content for doc in doc_vectorstore.similarity_search("", k=10)]
-            fallback_result = []
-            for req in req_blocks:
-                matches = any(req.lower() in doc.lower() for doc in doc_blocks)
-                # Используем нужный текст и в fallback
-                status = "соответствует ТЗ" if matches else "не соответствует ТЗ"
-                criticality = "нет" if matches else "высокая"
-                fallback_result.append({
-                    "requirement": req,
-                    "status": {"status": status, "criticality": criticality},
-                    "analysis": "Найдено в документации" if matches else "Не найдено в документации"
-                })
-            logger.info("Использован fallback в analyze_documents")
-            return fallback_result
+            logger.error(f"Ошибка при сравнении пакета {number}: {str(e)}")
+        logger.info(f"Использован fallback для пакета {number}")
+        return self.fallback_analysis(batch, evidence, doc_index)
+
+    async def analyze_documents(self, tz_index: HybridIndex, doc_index: HybridIndex, tz_content: Dict,
+                                requirements: Optional[List[Dict]] = None) -> List[Dict]:
+        """
+        Сравнивает требования ТЗ с документацией; requirements можно передать уже
+        извлечёнными (результат extract_tz_requirements).
+
+        Map-reduce: требования делятся на пакеты по оценке токенов, каждый пакет
+        получает свой контекст документации и сравнивается отдельным запросом.
+        Пакеты идут параллельно (их число в полёте ограничивает шлюз LLM), так что
+        время анализа определяется самым медленным пакетом. Ошибка пакета
+        заменяется fallback-оценкой только для его требований; исчерпание лимитов
+        ключей (LLMBudgetExhaustedError) прерывает анализ.
+        """
+        logger.info("Начало анализа документов...")
+        if requirements is None:
+            requirements = await self.extract_tz_requirements(tz_content)
+        req_blocks = [item["requirement"] for item in requirements]
+        if not req_blocks:
+            logger.warning("Требования для анализа не найдены")
+            return []
+        try:
+            evidence = await asyncio.to_thread(self.retrieve_evidence, req_blocks, doc_index)
+        except Exception as e:
+            logger.error(f"Ошибка поиска контекста документации: {str(e)}")
+            evidence = [[] for _ in req_blocks]
+
+        batches = self.batch_requirements(req_blocks)
+        logger.info(f"Сравнение {len(req_blocks)} требований в {len(batches)} пакетах")
+        batch_results = await asyncio.gather(*(
+            self.compare_batch(req_blocks[start:end], evidence[start:end], doc_index, number)
+            for number, (start, end) in enumerate(batches, 1)
+        ))
+        analysis_results = self.merge_analysis(batch_results)
+        # Смещения требования в ТЗ переносятся в результат, если LLM вернула его текст без изменений
+        spans = {self.requirement_key(item["requirement"]): item for item in requirements}
+        for result in analysis_results:
+            item = spans.get(self.requirement_key(result.get("requirement", "")))
+            if item:
+                result["tz_start"], result["tz_end"] = item["start"], item["end"]
+
+        logger.info(f"Итоговый анализ:\n{analysis_results}")
+        logger.info("Анализ документов завершен успешно")
+        return analysis_results
 
 # Глобальные функции
 rag_pipeline = RAGPipeline()
 
-def generate_analysis(tz_content: Dict, doc_content: Dict) -> List[Dict]:
+async def generate_analysis(tz_content: Dict, doc_content: Dict,
+                            requirements: Optional[List[Dict]] = None) -> List[Dict]:
     try:
-        tz_vectorstore, doc_vectorstore = rag_pipeline.process_documents(tz_content, doc_content)
-        analysis_results = rag_pipeline.analyze_documents(tz_vectorstore, doc_vectorstore, tz_content)
+        tz_index, doc_index = await asyncio.to_thread(rag_pipeline.process_documents, tz_content, doc_content)
+        analysis_results = await rag_pipeline.analyze_documents(tz_index, doc_index, tz_content, requirements)
         return analysis_results
     except Exception as e:
         logger.error(f"Ошибка при генерации анализа: {str(e)}")
         raise
 
 
-def find_most_relevant_chunk(query: str, text: str, chunk_size: int = 1000) -> str:
+def find_most_relevant_chunk(query: str, content: Dict, query_vector=None) -> str:
     """
-    Находит наиболее релевантный фрагмент текста для заданного требования.
+    Находит наиболее релевантный фрагмент текста для заданного требования
+    по гибридному индексу документа (BM25 + векторная близость).
 
-    Алгоритм:
-    1. Разбивает текст на чанки
-    2. Считает совпадения ключевых слов
-    3. Возвращает лучший фрагмент
+    content — {'md5_hash': str, 'document': StructuredDocument}; индекс берётся
+    из кэша RAGPipeline (обычно уже построен предобработкой).
     """
+    document = content['document']
+    text = document.text
     try:
-        # 1. Предварительная очистка текста
-        text = re.sub(r'\s+', ' ', text).strip()
-
-        # 2. Создаем сплиттер (как в основном пайплайне)
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=200,
-            separators=["\n\n", "\n", ". ", " ", ""]
-        )
-
-        # 3. Извлекаем ключевые слова из запроса
-        keywords = set()
-        for word in re.findall(r'\w+', query.lower()):
-            if len(word) > 3:  # Игнорируем короткие слова
-                keywords.add(word)
-
-        # 4. Ищем наиболее релевантный чанк
-        chunks = splitter.split_text(text)
-        best_chunk = ""
-        max_score = 0
-
-        for chunk in chunks:
-            score = sum(1 for keyword in keywords if keyword in chunk.lower())
-            if score > max_score:
-                max_score = score
-                best_chunk = chunk
-
-        return best_chunk if best_chunk else text[:chunk_size]  # Fallback
+        document_index = rag_pipeline.get_document_index(content['md5_hash'], document)
+        hits = document_index.search(query, query_vector, k=1)
+        if not hits:
+            return re.sub(r'\s+', ' ', text[:rag_pipeline.chunk_size]).strip()  # Fallback
+        chunk = document_index.chunks[hits[0][0]]
+        return re.sub(r'\s+', ' ', text[chunk["start"]:chunk["end"]]).strip()
 
     except Exception as e:
         logger.error(f"Ошибка поиска чанка: {str(e)}")
-        return text[:chunk_size]  # Возвращаем начало текста при ошибке
+        return text[:rag_pipeline.chunk_size]  # Возвращаем начало текста при ошибке
 
 
-def generate_detailed_explanation(
+async def generate_detailed_explanation(
         requirement: str,
         tz_content: Dict,
         doc_content: Dict,
@@ -370,27 +710,28 @@ def generate_detailed_explanation(
     Параметры:
         llm: Языковая модель (например ChatGroq)
         requirement: Текст требования
-        tz_content: Содержимое ТЗ {'raw_text': str}
-        doc_content: Содержимое документации {'raw_text': str}
+        tz_content: Содержимое ТЗ {'raw_text': str, 'md5_hash': str, 'document': StructuredDocument}
+        doc_content: Содержимое документации {'raw_text': str, 'md5_hash': str, 'document': StructuredDocument}
         card_analysis: Предварительный анализ из карточки
     """
-    # Ищем релевантные фрагменты
-    tz_chunk = find_most_relevant_chunk(requirement, tz_content['raw_text'])
-    doc_chunk = find_most_relevant_chunk(requirement, doc_content['raw_text'])
+    # Ищем релевантные фрагменты; запрос кодируется один раз для обоих документов
+    query_vector = await asyncio.to_thread(rag_pipeline.embeddings.embed_query, requirement)
+    tz_chunk, doc_chunk = await asyncio.gather(
+        asyncio.to_thread(find_most_relevant_chunk, requirement, tz_content, query_vector),
+        asyncio.to_thread(find_most_relevant_chunk, requirement, doc_content, query_vector)
+    )
 
 
     # Генерация ответа
-    response = rag_pipeline.llm.invoke(detailed_explanation_prompt.format(
+    return await rag_pipeline.gateway.ainvoke(detailed_explanation_prompt.format(
         requirement=requirement,
         tz_text=tz_chunk[:1500],
         doc_text=doc_chunk[:1500],
         card_analysis=card_analysis
-    ))
+    ), prompt_version=PROMPT_VERSIONS["detailed_explanation"], validate=lambda text: bool(text.strip()))
 
-    return response.content
 
-
-def explain_point(point: str) -> str:
+async def explain_point(point: str) -> str:
     try:
         explanation_prompt = """Перефразируй техническое требование в одно краткое предложение. 
         Используй простой язык без технических терминов. Только итоговую формулировку.
@@ -404,23 +745,22 @@ def explain_point(point: str) -> str:
 
         Теперь упрости: {point}"""
 
-        response = rag_pipeline.llm.invoke(
+        response = await rag_pipeline.gateway.ainvoke(
             explanation_prompt.format(point=point),
+            prompt_version=PROMPT_VERSIONS["explanation"],
+            validate=lambda text: bool(re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL).strip()),
             temperature=0  # Уменьшаем "творческость" модели
         )
 
         # Удаляем блок <think> и его содержимое
-        explanation = re.sub(r"<think>.*?</think>", "", response.content, flags=re.DOTALL).strip()
+        explanation = re.sub(r"<think>.*?</think>", "", response, flags=re.DOTALL).strip()
 
         # Постобработка: оставляем только первое предложение
         explanation = explanation.split(".")[0] + "." if "." in explanation else explanation
         return explanation.replace("Упрощённое:", "").strip()
 
+    except LLMBudgetExhaustedError:
+        raise
     except Exception as e:
-        if "429" in str(e) or "413" in str(e):  # Обработка 429 и 413
-            logger.warning(f"Ошибка {str(e).split()[2] if len(str(e).split()) > 2 else 'неизвестно'} в explain_point, переключение ключа...")
-            rag_pipeline.switch_api_key()
-            time.sleep(2)  # Задержка для соблюдения лимитов
-            return explain_point(point)  # Повторная попытка
         logger.error(f"Ошибка объяснения: {str(e)}")
         return f"Суть требования: {point.split('.')[0]}" if "." in point else point
@@ -1,5 +1,9 @@
 from fastapi import BackgroundTasks
-from database import db_manager
+from database import db_manager, AsyncSessionLocal
+from config import settings
+from file_storage import release_blob
+from preprocessing import document_preprocessor
+from llm_cache import llm_cache
 import asyncio
 import logging
 from datetime import datetime
@@ -10,7 +14,16 @@ async def cleanup_task():
     """Периодическая очистка старых файлов"""
     while True:
         try:
-            await db_manager.cleanup_old_files()
+            removed = await db_manager.cleanup_old_files()
+            async with AsyncSessionLocal() as session:
+                for stored_name, md5_hash in set(removed):
+                    await release_blob(session, settings.UPLOAD_DIR, stored_name)
+                    try:
+                        await document_preprocessor.release(session, md5_hash)
+                    except Exception as e:
+                        logger.error(f"Error releasing artifacts of {md5_hash}: {e}")
+            removed_responses = await llm_cache.prune()
+            logger.info(f"Removed {removed_responses} cached LLM responses")
             logger.info("Cleanup task completed successfully")
         except Exception as e:
             logger.error(f"Error in cleanup task: {e}")
@@ -0,0 +1,172 @@
+import asyncio
+import gzip
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from database import ExtractedText, UploadedFile
+from document_model import StructuredDocument
+from extraction_executor import extraction_executor
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentLRUCache:
+    """LRU-кэш извлечённых документов с ограничением суммарного размера в байтах."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._items: "OrderedDict[str, StructuredDocument]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[StructuredDocument]:
+        with self._lock:
+            document = self._items.get(key)
+            if document is not None:
+                self._items.move_to_end(key)
+            return document
+
+    def put(self, key: str, document: StructuredDocument) -> None:
+        size = document.nbytes
+        if size > self.max_bytes:
+            logger.info(f"Документ {key} ({size} байт) больше лимита кэша, не кэшируется")
+            return
+        with self._lock:
+            if key in self._items:
+                del self._items[key]
+                self.current_bytes -= self._sizes.pop(key)
+            self._items[key] = document
+            self._sizes[key] = size
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                evicted_key, _ = self._items.popitem(last=False)
+                self.current_bytes -= self._sizes.pop(evicted_key)
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            if self._items.pop(key, None) is not None:
+                self.current_bytes -= self._sizes.pop(key)
+
+
+document_cache = DocumentLRUCache(settings.TEXT_CACHE_MAX_BYTES)
+
+
+def _sidecar_path(md5_hash: str) -> str:
+    return os.path.join(settings.EXTRACTED_TEXT_DIR, f"{md5_hash}.txt.gz")
+
+
+def _offsets_path(md5_hash: str) -> str:
+    return os.path.join(settings.EXTRACTED_TEXT_DIR, f"{md5_hash}.offsets")
+
+
+def _write_sidecar(path: str, text: str) -> int:
+    """Атомарно записывает сжатый текст и возвращает размер файла."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def _write_document(text_path: str, offsets_path: str, document: StructuredDocument) -> int:
+    compressed_size = _write_sidecar(text_path, document.text)
+    document.save_offsets(offsets_path)
+    return compressed_size
+
+
+def _read_document(text_path: str, offsets_path: str) -> StructuredDocument:
+    """Читает сжатый текст; таблицы смещений отображаются в память (или строятся заново)."""
+    with gzip.open(text_path, "rt", encoding="utf-8") as f:
+        text = f.read()
+    if os.path.exists(offsets_path):
+        try:
+            return StructuredDocument.load(text, offsets_path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Повреждён файл смещений {offsets_path}: {str(e)}")
+    document = StructuredDocument.build(text)
+    document.save_offsets(offsets_path)
+    return document
+
+
+async def get_document(file: UploadedFile, file_path: str, db: AsyncSession) -> Optional[StructuredDocument]:
+    """
+    Возвращает извлечённый документ: нормализованный текст и таблицы смещений.
+
+    Порядок поиска: LRU в памяти процесса -> сжатый текст и файл смещений в
+    EXTRACTED_TEXT_DIR (строка ExtractedText) -> извлечение в пуле процессов
+    с сохранением результата.
+    """
+    md5_hash = file.md5_hash
+    document = document_cache.get(md5_hash)
+    if document is not None:
+        logger.info(f"Документ {file.original_name} взят из кэша в памяти")
+        return document
+
+    result = await db.execute(select(ExtractedText).where(ExtractedText.md5_hash == md5_hash))
+    cached = result.scalar_one_or_none()
+    if cached and os.path.exists(cached.text_path):
+        try:
+            document = await asyncio.to_thread(_read_document, cached.text_path, _offsets_path(md5_hash))
+            document_cache.put(md5_hash, document)
+            logger.info(f"Документ {file.original_name} взят из кэша на диске: {cached.text_path}")
+            return document
+        except (OSError, EOFError) as e:
+            logger.warning(f"Повреждён кэш текста {cached.text_path}, повторное извлечение: {str(e)}")
+
+    document = await extraction_executor.extract(file_path)
+    if document is None:
+        return None
+    text = document.text
+
+    text_path = _sidecar_path(md5_hash)
+    try:
+        compressed_size = await asyncio.to_thread(_write_document, text_path, _offsets_path(md5_hash), document)
+        if cached:
+            cached.text_path = text_path
+            cached.char_count = len(text)
+            cached.compressed_size = compressed_size
+            cached.created_at = datetime.utcnow()
+        else:
+            db.add(ExtractedText(
+                md5_hash=md5_hash,
+                text_path=text_path,
+                char_count=len(text),
+                compressed_size=compressed_size,
+                created_at=datetime.utcnow()
+            ))
+        await db.commit()
+        logger.info(f"Текст файла {file.original_name} сохранён в кэш: {text_path} ({compressed_size} байт)")
+    except IntegrityError:
+        # Параллельный запрос уже сохранил текст для этого хэша
+        await db.rollback()
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Не удалось сохранить кэш текста {text_path}: {str(e)}")
+
+    document_cache.put(md5_hash, document)
+    return document
+
+
+async def release_text(db: AsyncSession, md5_hash: str) -> None:
+    """Удаляет извлечённый текст документа: строку ExtractedText, сжатый текст и файл смещений."""
+    document_cache.discard(md5_hash)
+    cached = (await db.execute(select(ExtractedText).where(ExtractedText.md5_hash == md5_hash))).scalar_one_or_none()
+    paths = {_sidecar_path(md5_hash), _offsets_path(md5_hash)}
+    if cached:
+        paths.add(cached.text_path)
+        await db.execute(delete(ExtractedText).where(ExtractedText.md5_hash == md5_hash))
+        await db.commit()
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
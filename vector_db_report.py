@@ -0,0 +1,95 @@
+"""
+Отчёт о векторных индексах в vector_db: объём, экономия памяти относительно
+float32 и потеря recall@k для выбранных кодеков хранения.
+
+Примеры:
+    python vector_db_report.py
+    python vector_db_report.py --evaluate --codecs flat fp16 sq8 pq
+
+Без --evaluate выводятся сохранённые при сборке отчёты индексов документов и
+состояние библиотечного индекса. С --evaluate векторы библиотеки заново
+кодируются каждым кодеком и сравниваются с точным поиском.
+"""
+import argparse
+import glob
+import logging
+import os
+
+import numpy as np
+
+from ann_index import ANN_REPORT, CODECS, evaluate_codecs, load_ann_report
+from config import settings
+from vector_store import LibraryIndex
+
+logger = logging.getLogger(__name__)
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024 or unit == "ГБ":
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def report_document_indexes() -> None:
+    reports = [load_ann_report(os.path.dirname(path)) for path in
+               glob.glob(os.path.join(settings.VECTOR_DB_PATH, "documents", "**", ANN_REPORT), recursive=True)]
+    reports = [report for report in reports if report and "index_bytes" in report]
+    print(f"Индексы документов: {len(reports)}")
+    if not reports:
+        return
+    by_codec = {}
+    for report in reports:
+        totals = by_codec.setdefault(report["codec"], {"indexes": 0, "vectors": 0, "bytes": 0, "float32": 0,
+                                                       "recall": []})
+        totals["indexes"] += 1
+        totals["vectors"] += report["vectors"]
+        totals["bytes"] += report["index_bytes"]
+        totals["float32"] += report["float32_bytes"]
+        totals["recall"].append(report["recall_at_k"])
+    for codec, totals in sorted(by_codec.items()):
+        saved = 100 * (1 - totals["bytes"] / totals["float32"])
+        print(f"  {codec}: {totals['indexes']} индексов, {totals['vectors']} векторов, "
+              f"{format_bytes(totals['bytes'])} (float32: {format_bytes(totals['float32'])}, экономия {saved:.1f}%), "
+              f"recall@{settings.ANN_RECALL_K}: min {min(totals['recall']):.4f}, "
+              f"mean {np.mean(totals['recall']):.4f}")
+
+
+def library_directories():
+    return sorted(path for path in glob.glob(os.path.join(settings.LIBRARY_INDEX_DIR, "*")) if os.path.isdir(path))
+
+
+def report_library(evaluate: bool, codecs, queries: int, k: int) -> None:
+    for directory in library_directories():
+        library_index = LibraryIndex(directory, codec=settings.LIBRARY_CODEC)
+        stats = library_index.stats()
+        print(f"Библиотека {os.path.basename(directory)}: {stats['documents']} документов, {stats['chunks']} чанков, "
+              f"кодек {stats['codec']} (в памяти: {stats['storage']}), {format_bytes(stats['memory_bytes'])} "
+              f"(float32: {format_bytes(stats['float32_bytes'])})")
+        if not evaluate or not stats["chunks"]:
+            continue
+        segments = sorted(glob.glob(os.path.join(directory, "*.npy")))
+        vectors = np.concatenate([np.load(path).astype(np.float32) for path in segments])
+        print(f"  {'кодек':<6} {'байт/вектор':>12} {'индекс':>12} {'экономия':>9} {f'recall@{k}':>10} {'мс/запрос':>10}")
+        for result in evaluate_codecs(vectors, codecs, k=k, n_queries=queries):
+            codec = result["codec"] if result["codec"] == result["requested_codec"] \
+                else f"{result['requested_codec']}->{result['codec']}"
+            print(f"  {codec:<6} {result['bytes_per_vector']:>12} {format_bytes(result['index_bytes']):>12} "
+                  f"{result['saved_percent']:>8}% {result['recall_at_k']:>10} {result['ms_per_query']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--evaluate", action="store_true", help="сравнить кодеки на векторах библиотеки")
+    parser.add_argument("--codecs", nargs="+", default=list(CODECS), choices=CODECS)
+    parser.add_argument("--queries", type=int, default=settings.ANN_RECALL_QUERIES)
+    parser.add_argument("--k", type=int, default=settings.ANN_RECALL_K)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    report_document_indexes()
+    report_library(args.evaluate, args.codecs, args.queries, args.k)
+
+
+if __name__ == "__main__":
+    main()
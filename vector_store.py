@@ -1,10 +1,266 @@
-import chromadb
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
 
-db = chromadb.PersistentClient(path="./chroma_db")
-collection = db.get_or_create_collection(name="documents")
+import numpy as np
+from filelock import FileLock
 
-def add_document(text, doc_id):
-    collection.add(ids=[doc_id], documents=[text])
+from ann_index import CODEC_MIN_TRAIN, codec_factory, resolve_codec
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LibraryIndex:
+    """
+    Библиотечный векторный индекс по всем загруженным документам.
+
+    Каждый документ хранится отдельным сегментом: <md5>.json со смещениями и
+    текстом чанков и <md5>.npy с их векторами (появляется последним и служит
+    признаком готовности сегмента). Добавление и удаление документа затрагивают
+    только его сегмент. В памяти процесса сегменты собраны в один FAISS
+    IndexIDMap2, который сверяется с каталогом по счётчику поколений, поэтому
+    изменения из других процессов подхватываются при следующем обращении.
+
+    Кодек хранения (codec): flat — float32, fp16 — float16 (сегменты на диске
+    тоже в float16), sq8/pq — квантованные коды. Квантователь sq8/pq обучается
+    один раз, когда в библиотеке набирается CODEC_MIN_TRAIN векторов, и
+    сохраняется рядом (codec-<кодек>.faiss); до этого векторы хранятся в float32.
+    """
+
+    def __init__(self, directory: str, codec: str = "flat"):
+        self.directory = directory
+        self.codec = resolve_codec(codec, CODEC_MIN_TRAIN.get(codec, 0))
+        self._storage: Optional[str] = None  # фактический кодек индекса в памяти
+        self._template_path = os.path.join(directory, f"codec-{self.codec}.faiss")
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(os.path.join(directory, "library.lock"))
+        self._generation_path = os.path.join(directory, "generation")
+        self._index = None
+        self._segments: Dict[str, np.ndarray] = {}  # md5 -> id векторов в FAISS
+        self._chunks: Dict[int, Tuple[str, Dict]] = {}  # id вектора -> (md5, чанк)
+        self._next_id = 0
+        self._generation: Optional[int] = None
+
+    def _segment_path(self, md5_hash: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{md5_hash}{extension}")
+
+    def _stored_segments(self) -> set:
+        return {name[:-len(".npy")] for name in os.listdir(self.directory) if name.endswith(".npy")}
+
+    def _new_index(self, dim: int):
+        import faiss
+        if self.codec == "fp16":
+            inner, self._storage = faiss.index_factory(dim, codec_factory("fp16", dim)), "fp16"
+        elif self.codec in CODEC_MIN_TRAIN and os.path.exists(self._template_path):
+            inner, self._storage = faiss.read_index(self._template_path), self.codec
+        else:
+            inner, self._storage = faiss.IndexFlatL2(dim), "flat"
+        return faiss.IndexIDMap2(inner)
+
+    def _load_segment(self, md5_hash: str) -> None:
+        vectors = np.load(self._segment_path(md5_hash, ".npy")).astype(np.float32)
+        with open(self._segment_path(md5_hash, ".json"), encoding="utf-8") as f:
+            chunks = json.load(f)
+        if len(vectors) != len(chunks):
+            raise ValueError(f"Сегмент {md5_hash} повреждён: {len(vectors)} векторов, {len(chunks)} чанков")
+        if self._index is None:
+            self._index = self._new_index(vectors.shape[1])
+        ids = np.arange(self._next_id, self._next_id + len(vectors), dtype=np.int64)
+        self._next_id += len(vectors)
+        self._index.add_with_ids(vectors, ids)
+        self._segments[md5_hash] = ids
+        for vector_id, chunk in zip(ids, chunks):
+            self._chunks[int(vector_id)] = (md5_hash, chunk)
+
+    def _unload_segment(self, md5_hash: str) -> None:
+        ids = self._segments.pop(md5_hash)
+        self._index.remove_ids(ids)
+        for vector_id in ids:
+            self._chunks.pop(int(vector_id), None)
+
+    def _read_generation(self) -> int:
+        try:
+            with open(self._generation_path, encoding="utf-8") as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _bump_generation(self) -> None:
+        """Увеличивает счётчик поколений (вызывается под файловой блокировкой)."""
+        tmp_path = f"{self._generation_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(self._read_generation() + 1))
+        os.replace(tmp_path, self._generation_path)
+
+    def _sync(self) -> None:
+        """Приводит индекс в памяти к составу сегментов на диске (вызывается под self._lock)."""
+        # Поколение читаем до листинга: изменение во время листинга вызовет повторную сверку
+        generation = self._read_generation()
+        if generation == self._generation:
+            return
+        stored = self._stored_segments()
+        for md5_hash in set(self._segments) - stored:
+            self._unload_segment(md5_hash)
+        for md5_hash in stored - set(self._segments):
+            try:
+                self._load_segment(md5_hash)
+            except (OSError, ValueError) as e:
+                logger.error(f"Ошибка загрузки сегмента библиотеки {md5_hash}: {str(e)}")
+        self._generation = generation
+        if self._storage == "flat" and self.codec in CODEC_MIN_TRAIN:
+            self._maybe_switch_codec()
+
+    def _maybe_switch_codec(self) -> None:
+        """Переводит индекс в памяти на обученный квантователь, когда он есть или его можно обучить."""
+        if not os.path.exists(self._template_path):
+            if len(self._chunks) < CODEC_MIN_TRAIN[self.codec]:
+                return
+            import faiss
+            vectors = np.concatenate([np.load(self._segment_path(md5_hash, ".npy")).astype(np.float32)
+                                      for md5_hash in self._segments])
+            sample = vectors[np.random.default_rng(0).choice(
+                len(vectors), min(len(vectors), settings.VECTOR_CODEC_TRAIN_SIZE), replace=False)]
+            template = faiss.index_factory(vectors.shape[1], codec_factory(self.codec, vectors.shape[1]))
+            template.train(sample)
+            with self._file_lock:
+                if not os.path.exists(self._template_path):
+                    faiss.write_index(template, f"{self._template_path}.tmp")
+                    os.replace(f"{self._template_path}.tmp", self._template_path)
+            logger.info(f"Квантователь {self.codec} библиотеки обучен на {len(sample)} векторах")
+        # Пересобираем индекс в памяти из сегментов уже в новом кодеке
+        self._index, self._segments, self._chunks, self._next_id = None, {}, {}, 0
+        for md5_hash in self._stored_segments():
+            try:
+                self._load_segment(md5_hash)
+            except (OSError, ValueError) as e:
+                logger.error(f"Ошибка загрузки сегмента библиотеки {md5_hash}: {str(e)}")
+
+    def contains(self, md5_hash: str) -> bool:
+        return os.path.exists(self._segment_path(md5_hash, ".npy"))
+
+    def add_document(self, md5_hash: str, chunks: List[Dict], vectors: np.ndarray) -> bool:
+        """Добавляет сегмент документа; возвращает False, если документ уже в библиотеке."""
+        with self._file_lock:
+            if self.contains(md5_hash):
+                return False
+            json_path = self._segment_path(md5_hash, ".json")
+            with open(f"{json_path}.tmp", "w", encoding="utf-8") as f:
+                json.dump(chunks, f, ensure_ascii=False)
+            os.replace(f"{json_path}.tmp", json_path)
+            npy_path = self._segment_path(md5_hash, ".npy")
+            with open(f"{npy_path}.tmp", "wb") as f:
+                np.save(f, np.asarray(vectors, dtype=np.float32 if self.codec == "flat" else np.float16))
+            os.replace(f"{npy_path}.tmp", npy_path)
+            self._bump_generation()
+        with self._lock:
+            self._sync()
+        logger.info(f"Документ {md5_hash} добавлен в библиотечный индекс: {len(chunks)} чанков")
+        return True
+
+    def remove_document(self, md5_hash: str) -> bool:
+        """
+        Удаляет файлы сегмента и увеличивает счётчик поколений; индекс в памяти
+        сверится с каталогом при следующем поиске.
+        """
+        with self._file_lock:
+            if not self.contains(md5_hash):
+                return False
+            os.remove(self._segment_path(md5_hash, ".npy"))
+            json_path = self._segment_path(md5_hash, ".json")
+            if os.path.exists(json_path):
+                os.remove(json_path)
+            self._bump_generation()
+        logger.info(f"Документ {md5_hash} удалён из библиотечного индекса")
+        return True
+
+    def search(self, query_vectors: np.ndarray, k: int) -> List[List[Dict]]:
+        """Ближайшие чанки библиотеки для каждого запроса: {"md5_hash", "distance", ...чанк}."""
+        query_vectors = np.ascontiguousarray(np.atleast_2d(query_vectors), dtype=np.float32)
+        with self._lock:
+            self._sync()
+            if self._index is None or self._index.ntotal == 0:
+                return [[] for _ in query_vectors]
+            distances, ids = self._index.search(query_vectors, min(k, self._index.ntotal))
+            results = []
+            for row_distances, row_ids in zip(distances, ids):
+                hits = []
+                for distance, vector_id in zip(row_distances, row_ids):
+                    if vector_id < 0:
+                        continue
+                    md5_hash, chunk = self._chunks[int(vector_id)]
+                    hits.append(dict(chunk, md5_hash=md5_hash, distance=float(distance)))
+                results.append(hits)
+            return results
+
+    def similar_documents(self, md5_hash: str, k: int, chunks_per_query: int = 10) -> List[Dict]:
+        """
+        Документы, похожие на данный: каждый его чанк ищется в библиотеке, голоса
+        за другие документы суммируются с весом 1 / (ранг + 1).
+        """
+        if not self.contains(md5_hash):
+            return []
+        vectors = np.load(self._segment_path(md5_hash, ".npy"))
+        scores: Dict[str, float] = defaultdict(float)
+        matched: Dict[str, set] = defaultdict(set)
+        for hits in self.search(vectors, chunks_per_query + 1):
+            rank = 0
+            for hit in hits:
+                if hit["md5_hash"] == md5_hash:
+                    continue
+                scores[hit["md5_hash"]] += 1 / (rank + 1)
+                matched[hit["md5_hash"]].add(hit["chunk_id"])
+                rank += 1
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [{"md5_hash": other, "score": round(score / len(vectors), 4), "matched_chunks": len(matched[other])}
+                for other, score in ranked]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._sync()
+            stats = {"documents": len(self._segments), "chunks": len(self._chunks),
+                     "codec": self.codec, "storage": self._storage, "memory_bytes": 0, "float32_bytes": 0}
+            if self._index is not None:
+                import faiss
+                code_size = faiss.downcast_index(self._index.index).sa_code_size()
+                # Коды векторов + id в IDMap2 и обратной таблице
+                stats["memory_bytes"] = self._index.ntotal * (code_size + 24)
+                stats["float32_bytes"] = self._index.ntotal * self._index.d * 4
+            return stats
+
+
+_library_index: Optional[LibraryIndex] = None
+_library_lock = threading.Lock()
+
+
+def get_library_index() -> LibraryIndex:
+    """Библиотечный индекс для текущей модели эмбеддингов (создаётся при первом обращении)."""
+    global _library_index
+    if _library_index is None:
+        with _library_lock:
+            if _library_index is None:
+                from rag_pipeline import rag_pipeline
+                _library_index = LibraryIndex(os.path.join(settings.LIBRARY_INDEX_DIR, rag_pipeline.embedding_slug),
+                                              codec=settings.LIBRARY_CODEC)
+    return _library_index
+
+
+def add_document(md5_hash: str, document_index) -> bool:
+    """Добавляет чанки документа (из его гибридного индекса) в библиотеку; эмбеддинги берутся из кэша."""
+    from rag_pipeline import rag_pipeline
+    library_index = get_library_index()
+    if library_index.contains(md5_hash) or not len(document_index):
+        return False
+    vectors = rag_pipeline.embeddings.embed_documents([chunk["content"] for chunk in document_index.chunks])
+    return library_index.add_document(md5_hash, document_index.chunks, np.asarray(vectors, dtype=np.float32))
+
+
+def search_similar(text: str, top_k: int = None) -> List[Dict]:
+    from rag_pipeline import rag_pipeline
+    query_vector = np.asarray(rag_pipeline.embeddings.embed_query(text), dtype=np.float32)
+    return get_library_index().search(query_vector, top_k or settings.LIBRARY_SEARCH_TOP_K)[0]
 
-def search_similar(text, top_k=3):
-    return collection.query(query_texts=[text], n_results=top_k)